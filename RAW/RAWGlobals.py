@@ -27,16 +27,14 @@ import os
 if sys.version_info < (3, 0):
     isPY2 = True
     # from SASExceptions import ModuleNotFoundError
-    try:
-        try:
-            import weave
-        except Exception:
-            import scipy.weave as weave
-        compiled_extensions = True
-    except Exception:
-        compiled_extensions = False
 else:
     isPY2 = False
+
+# Compiled extensions are built explicitly with SASbuild_Clibs.py, never on import
+try:
+    import ravg_ext, polygonmask_ext
+    compiled_extensions = True
+except ImportError:
     compiled_extensions = False
 
 # global mainworker_cmd_queue
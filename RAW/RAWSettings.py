@@ -100,6 +100,10 @@ class RawGuiSettings:
                             'StartPoint' : [0,     NewId(), 'int'],
                             'EndPoint'   : [0,     NewId(), 'int'],
                             'ImageDim'   : [[1024,1024]],
+                            'QBinning'   : ['Pixel', NewId(), 'choice'],  # 'Pixel', 'Linear' or 'Log', integrate straight onto q-bins if not 'Pixel'
+                            'QBinMin'    : [0.0,   NewId(), 'float'],   # 1/A, <= 0 for the q of the first pixel
+                            'QBinMax'    : [0.0,   NewId(), 'float'],   # 1/A, <= 0 for the q of the image corner
+                            'QBinNumber' : [500,   NewId(), 'int'],
 
                             #MASKING
                             'SampleFile'              : [None, NewId(), 'text'],
@@ -172,6 +176,7 @@ class RawGuiSettings:
                             #ARTIFACT REMOVAL:
                             'ZingerRemovalRadAvg'    : [False, NewId(), 'bool'],
                             'ZingerRemovalRadAvgStd' : [4.0,     NewId(), 'float'],
+                            'ZingerRemovalRadAvgSpread' : ['Std', NewId(), 'choice'],   #'Std' or 'MAD'
 
                             'ZingerRemoval'     : [False, NewId(), 'bool'],
                             'ZingerRemoveSTD'   : [4,     NewId(), 'int'],
@@ -197,6 +202,18 @@ class RawGuiSettings:
                             'ImageFormatList'      : [SASFileIO.all_image_types],
                             'ImageFormat'          : ['Pilatus', NewId(), 'choice'],
 
+                            #RADIAL AVERAGING
+                            'IntegrationWorkers'   : [1, NewId(), 'int'],   #Threads used to integrate large images
+                            'LoadProcesses'        : [1, NewId(), 'int'],   #Processes used by RAWSimulator.loadSASMs, 1 loads in the calling process
+                            'PrefetchDepth'        : [0, NewId(), 'int'],   #Images read ahead on background threads by RAWSimulator.loadSASMs
+                            'PrefetchMaxBytes'     : [0, NewId(), 'int'],   #Largest total file size read ahead, 0 for no limit
+                            'StreamImageFrames'    : [False, NewId(), 'bool'],  #Integrate and drop the frames of multi-frame files one at a time in RAWSimulator.loadSASMs
+                            'IntegrationFloat32'   : [False, NewId(), 'bool'],  #Sum the bins in float32 instead of float64
+                            'IntegrationBackend'   : ['Auto', NewId(), 'choice'],   #'Auto' or a name in SASImage.integration_backends
+                            'IntegrationMode'      : ['Mean', NewId(), 'choice'],   #'Mean', 'Median' or 'SigmaClip'
+                            'IntegrationClipSigma' : [3.0, NewId(), 'float'],
+                            'IntegrationClipIterations' : [5, NewId(), 'int'],
+
                             #HEADER FORMATS
                             'ImageHdrFormatList'   : [SASFileIO.all_header_types],
                             'ImageHdrFormat'       : ['None', NewId(), 'choice'],
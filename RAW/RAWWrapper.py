@@ -3,7 +3,10 @@ from __future__ import print_function, division
 import os
 import sys
 import copy
-import glob
+import pickle
+import traceback
+import weakref
+import multiprocessing
 from io import TextIOBase, open
 
 import numpy as np
@@ -24,9 +27,71 @@ from RAWUtils import findATSASDirectory, ErrorPrinter
 from RAWAnalysisWrapper import RAWAnalysisSimulator
 
 
+# settings and integration geometries of a loadSASMs worker process
+_worker_settings = None
+_worker_geometry_cache = None
+
+
+def _initLoadWorker(raw_settings):
+    """Keep one copy of the settings (with the mask matrices) per worker."""
+    global _worker_settings, _worker_geometry_cache
+    _worker_settings = raw_settings
+    _worker_geometry_cache = SASImage.GeometryCache()
+
+
+def _loadFrames(filename, raw_settings, geometry_cache, loaded_image=None):
+    """Load one file, returning its (sasm, is_image) pairs.
+
+    With the StreamImageFrames setting, the pairs are yielded by a generator
+    that integrates the frames of the file one at a time (see
+    SASFileIO.iterFile), so only the current frame is kept in memory.
+    Otherwise the whole file is loaded with SASFileIO.loadFile.
+    """
+    if raw_settings.get('StreamImageFrames') and loaded_image is None:
+        return ((sasm, img is not None) for sasm, img in
+                SASFileIO.iterFile(filename, raw_settings,
+                                   geometry_cache=geometry_cache))
+
+    sasm, img = SASFileIO.loadFile(filename, raw_settings,
+                                   geometry_cache=geometry_cache,
+                                   loaded_image=loaded_image)
+
+    if not isinstance(sasm, list):
+        sasm = [sasm]
+
+    return [(each, img is not None) for each in sasm]
+
+
+def _loadFileInWorker(filename):
+    """Load one file in a worker process.
+
+    Returns the list of (sasm, is_image) pairs of the file, and the
+    exception raised while loading or None. Exceptions that do not survive
+    pickling are replaced by a RuntimeError with the worker traceback.
+    """
+    try:
+        frames = list(_loadFrames(filename, _worker_settings,
+                                  _worker_geometry_cache))
+    except Exception as error:
+        worker_traceback = traceback.format_exc()
+
+        try:
+            pickle.loads(pickle.dumps(error))
+        except Exception:
+            error = RuntimeError(worker_traceback)
+
+        return None, error
+
+    return frames, None
+
+
 class RAWSimulator():
     """ RAW operator """
 
+    # settings the cached integration geometry depends on
+    _geometry_keys = ('Xcenter', 'Ycenter', 'Masks', 'BeamStopMask',
+                      'ReadOutNoiseMask', 'TransparentBSMask')
+
     def __init__(self, raw_cfg_path, log_file=None, do_analysis=False):
         # load configuration
         print(raw_cfg_path)
@@ -52,6 +117,12 @@ class RAWSimulator():
             self._stdout = log_file
         self.error_printer = ErrorPrinter(self._raw_settings, self._stdout)
 
+        # integration geometry reused between images, see _invalidateGeometry
+        self._geometry_cache = SASImage.GeometryCache()
+
+        # worker processes of loadSASMs, see _getLoadPool
+        self._load_pool = None
+
         # create mask
         self._createMasks()
 
@@ -63,41 +134,114 @@ class RAWSimulator():
     # close file
     #    self._stdout.close()
 
+    def _invalidateGeometry(self):
+        """Drop cached integration geometries after center or mask changes."""
+        self._geometry_cache.clear()
+
+    def _getLoadPool(self, processes):
+        """Return the worker pool of loadSASMs, started on first use.
+
+        The workers are kept between calls, each with its own copy of the
+        settings and cached geometries, until the settings change.
+        """
+        if self._load_pool is not None and self._load_pool[0] != processes:
+            self.closeLoadPool()
+
+        if self._load_pool is None:
+            pool = multiprocessing.Pool(processes, _initLoadWorker,
+                                        (self._raw_settings,))
+            # stop the workers if the simulator is dropped, or at exit,
+            # without closeLoadPool being called
+            finalizer = weakref.finalize(self, pool.terminate)
+            self._load_pool = (processes, pool, finalizer)
+
+        return self._load_pool[1]
+
+    def _iterLoadPool(self, processes, filename_list):
+        """Yield the worker results for filename_list in order.
+
+        If the caller stops before the last result (e.g. on an error), the
+        pool is terminated, so the remaining files are not loaded.
+        """
+        finished = not filename_list
+        try:
+            results = self._getLoadPool(processes).imap(_loadFileInWorker,
+                                                         filename_list)
+            for count, result in enumerate(results, 1):
+                # the caller may not ask for more after the last result
+                finished = count == len(filename_list)
+                yield result
+        finally:
+            if not finished:
+                self.closeLoadPool(terminate=True)
+
+    def closeLoadPool(self, terminate=False):
+        """Stop the worker processes of loadSASMs, if any.
+
+        With terminate, the workers are stopped without finishing the
+        files they were given.
+        """
+        if self._load_pool is not None:
+            processes, pool, finalizer = self._load_pool
+            self._load_pool = None
+            finalizer.detach()
+            if terminate:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.closeLoadPool()
+
     def _createMasks(self, overwrite_cached=False):
-        """Create mask from mask objects."""
+        """Create mask from mask objects.
+
+        Mask matrices are cached as boolean .npy files next to the config
+        file, named by a digest of the mask objects, so a changed mask is
+        never reused. The cached files are memory mapped, so simulators and
+        worker processes using the same mask share its pages.
+        """
         print(u'Please wait while creating masks...', file=self._stdout)
+        self._invalidateGeometry()
+        self.closeLoadPool()
         mask_dict = self._raw_settings.get('Masks')
-        img_dim = self._raw_settings.get('MaskDimension')
+        img_dim = tuple(self._raw_settings.get('MaskDimension'))
 
         cfg_path = self._raw_settings.get('CurrentCfg')
         cfg_name, _ = os.path.splitext(cfg_path)
 
-        # mask path: /where/is/the/cfgfile/cfgname-BeamStopMask.npy
-        cached_path = glob.glob('{0}-{1}'.format(cfg_name, '*Mask*.npy'))
-        cached_masks = {
-            os.path.splitext(mask_path.split('-')[-1])[0]: mask_path
-            for mask_path in cached_path
-        }
-
         for each_key in mask_dict.keys():
             # each_key: 'TransparentBSMask', 'BeamStopMask', 'ReadOutNoiseMask'
             # mask_dict[key] = [mask_matrix, mask_object]
             masks = mask_dict[each_key][1]
             if masks is not None:
-                if each_key in cached_masks:
-                    mask_img = np.load(cached_masks[each_key])
-                else:
+                # mask path: /where/is/the/cfgfile/cfgname-BeamStopMask-<digest>.npy
+                digest = SASImage.getMaskObjectsDigest(img_dim, masks)
+                cached_path = '{0}-{1}-{2}.npy'.format(cfg_name, each_key,
+                                                       digest[:16])
+
+                mask_img = None
+                if not overwrite_cached and os.path.exists(cached_path):
+                    try:
+                        mask_img = SASImage.loadMaskMatrix(cached_path, img_dim)
+                    except (IOError, ValueError) as error:
+                        print(u'Ignoring cached mask: {}'.format(error),
+                              file=self._stdout)
+
+                if mask_img is None:
                     mask_img = SASImage.createMaskMatrix(img_dim, masks)
+                    SASImage.saveMaskMatrix(cached_path, mask_img)
+                    mask_img = SASImage.loadMaskMatrix(cached_path, img_dim)
+
                 mask_param = mask_dict[each_key]
                 self._raw_settings.set(each_key, mask_img)
                 mask_param[0] = mask_img
                 mask_param[1] = masks
 
-                if overwrite_cached:
-                    np.save('{0}-{1}'.format(cfg_name, each_key), mask_img)
-                elif each_key not in cached_masks:
-                    np.save('{0}-{1}'.format(cfg_name, each_key), mask_img)
-
     def get_raw_settings(self):
         return self._raw_settings
 
@@ -111,6 +255,12 @@ class RAWSimulator():
         for key, val in kwargs.items():
             self._raw_settings.set(key, val)
 
+        if any(key in self._geometry_keys for key in kwargs):
+            self._invalidateGeometry()
+
+        # the workers hold a copy of the old settings
+        self.closeLoadPool()
+
     def analyse(self, sasm):
         """
         sasm is SASM object instead of a list object
@@ -202,54 +352,79 @@ class RAWSimulator():
         # wavelength = self._raw_settings.get('WaveLength')
         # sasm.calibrateQ(sd_distance, pixel_size, wavelength)
 
+    def _loadFile(self, filename, loaded_image=None):
+        """Load one file in this process, as _loadFileInWorker. When
+        streaming, loading errors are raised while the frames are read."""
+        return _loadFrames(filename, self._raw_settings, self._geometry_cache,
+                           loaded_image), None
+
     def loadSASMs(self, filename_list):
-        """Load image or dat files."""
+        """Load image or dat files.
+
+        With the LoadProcesses setting above 1, the files are loaded and
+        integrated in that many worker processes. The results are handled
+        here in the order of filename_list.
+
+        Otherwise, with PrefetchDepth above 0 (and StreamImageFrames off),
+        the next images are read on background threads while the current one
+        is integrated (see SASFileIO.prefetchImages).
+
+        With StreamImageFrames, the frames of multi-frame files are
+        integrated and dropped one at a time instead of being read together
+        (see _loadFrames). Frames read with fabio, and .npy stacks, are then
+        never all in memory. Other multi-frame formats are still read whole
+        by their loaders.
+        """
         print(u'Please wait while loading files...', file=self._stdout)
         sasm_list = []
         do_auto_save = self._raw_settings.get('AutoSaveOnImageFiles')
+        processes = self._raw_settings.get('LoadProcesses')
+        prefetch_depth = self._raw_settings.get('PrefetchDepth')
+
+        if processes > 1 and len(filename_list) > 1:
+            results = self._iterLoadPool(processes, filename_list)
+        elif (prefetch_depth > 0 and len(filename_list) > 1
+              and not self._raw_settings.get('StreamImageFrames')):
+            prefetched = SASFileIO.prefetchImages(
+                filename_list, self._raw_settings.get('ImageFormat'),
+                prefetch_depth, self._raw_settings.get('PrefetchMaxBytes'))
+            results = (self._loadFile(each, loaded_image)
+                       for each, loaded_image in prefetched)
+        else:
+            results = (self._loadFile(each) for each in filename_list)
 
         try:
             for each_filename in filename_list:
                 # file_ext = os.path.splitext(each_filename)[1]
-                sasm, img = SASFileIO.loadFile(each_filename,
-                                               self._raw_settings)
+                frames, error = next(results)
 
-                if img is not None:
-                    # qrange = sasm.getQrange()
-                    start_point = self._raw_settings.get('StartPoint')
-                    end_point = self._raw_settings.get('EndPoint')
+                if error is not None:
+                    raise error
+
+                for sasm, is_image in frames:
+                    if is_image:
+                        # qrange = sasm.getQrange()
+                        start_point = self._raw_settings.get('StartPoint')
+                        end_point = self._raw_settings.get('EndPoint')
 
-                    if isinstance(sasm, list):
-                        qrange = (start_point,
-                                  len(sasm[0].getBinnedQ()) - end_point)
-                        for each_sasm in sasm:
-                            each_sasm.setQrange(qrange)
-                    else:
                         qrange = (start_point,
                                   len(sasm.getBinnedQ()) - end_point)
                         sasm.setQrange(qrange)
 
-                    if do_auto_save:
-                        save_path = self._raw_settings.get('ProcessedFilePath')
-                        if not os.path.exists(save_path):
-                            os.makedirs(save_path)
-                        elif not os.path.isdir(save_path):
-                            raise NotADirectoryError(
-                                "target save path isn't a directory.")
-                        try:
-                            if isinstance(sasm, list):
-                                for each in sasm:
-                                    self.saveSASM(each, '.dat', save_path)
-                            else:
+                        if do_auto_save:
+                            save_path = self._raw_settings.get('ProcessedFilePath')
+                            if not os.path.exists(save_path):
+                                os.makedirs(save_path)
+                            elif not os.path.isdir(save_path):
+                                raise NotADirectoryError(
+                                    "target save path isn't a directory.")
+                            try:
                                 self.saveSASM(sasm, '.dat', save_path)
-                        except IOError as error:
-                            self._raw_settings.set('AutoSaveOnImageFiles',
-                                                   False)
-                            do_auto_save = False
+                            except IOError as error:
+                                self._raw_settings.set('AutoSaveOnImageFiles',
+                                                       False)
+                                do_auto_save = False
 
-                if isinstance(sasm, list):
-                    sasm_list.extend(sasm)
-                else:
                     sasm_list.append(sasm)
 
         except (SASExceptions.UnrecognizedDataFormat,
@@ -276,6 +451,8 @@ class RAWSimulator():
                 'Mask information was not found in header',
                 file=self._stdout)
             raise error
+        finally:
+            results.close()
 
         return sasm_list
 
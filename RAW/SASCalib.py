@@ -71,6 +71,36 @@ def calcTheta(sd_distance, pixel_size, q_length_pixels):
         theta = .5 * atan( (q_length_pixels * pixel_size) / sd_distance )
         return theta
 
+def calcQFromPixels(q_length_pixels, sd_distance, pixel_size, wavelength):
+    '''
+     Calculates q (1/A) from the length of the q-vector in pixels, the same
+     as SASM.calibrateQ. Works on arrays.
+    '''
+
+    theta = .5 * np.arctan( (np.asarray(q_length_pixels, dtype = np.float64) * pixel_size) / sd_distance )
+
+    return (4 * pi * np.sin(theta)) / wavelength
+
+def calcPixelsFromQ(q, sd_distance, pixel_size, wavelength):
+    '''
+     Calculates the length of the q-vector in pixels for q (1/A), the
+     inverse of calcQFromPixels. Works on arrays.
+    '''
+
+    theta = np.arcsin( (np.asarray(q, dtype = np.float64) * wavelength) / (4 * pi) )
+
+    return (sd_distance * np.tan(2 * theta)) / pixel_size
+
+def calcSolidAngleCorrectionFromQ(q, wavelength):
+    '''
+     Same as calcSolidAngleCorrection, for q values already calibrated to
+     1/A. Returns cos^3(2*theta) for each q.
+    '''
+
+    theta = np.arcsin( (np.asarray(q, dtype = np.float64) * wavelength) / (4 * pi) )
+
+    return np.power(np.cos(2 * theta), 3)
+
 def calcSolidAngleCorrection(sasm, sd_distance, pixel_size):
     '''
       returns an array that should be multiplied to the intensity values
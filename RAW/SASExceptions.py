@@ -27,84 +27,98 @@ if sys.version_info < (3, 6):
     # ModuleNotFoundError was added in Python 3.6
     class ModuleNotFoundError(Exception):
         def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
         def __str__(self):
            return repr(self.parameter)
 
     class NotADirectoryError(Exception):
         def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
         def __str__(self):
            return repr(self.parameter)
 
 class WrongImageFormat(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class MaskSizeError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class UnrecognizedDataFormat(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class DataNotCompatible(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class InvalidQrange(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class CenterNotFound(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class AbsScaleNormFailed(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class NormalizationError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class HeaderLoadError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class HeaderMaskLoadError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class NoATSASError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
 
 class HeaderSaveError(Exception):
        def __init__(self, value):
+           Exception.__init__(self, value)
            self.parameter = value
        def __str__(self):
            return repr(self.parameter)
@@ -31,14 +31,15 @@ except ImportError:
     print('RAW WARNING: hdf5plugin not present, Eiger hdf5 images will not load.')
     use_eiger = False
 
-import os, sys, re, time, binascii, struct, json, copy
+import os, sys, re, time, binascii, struct, json, copy, collections
+import multiprocessing.pool
 import numpy as np
 from xml.dom import minidom
 
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
     sys.path.append(RAW_DIR)
-import RAWGlobals, SASImage, SASM, SASExceptions
+import RAWGlobals, SASImage, SASM, SASExceptions, SASCalib
 import SASMarHeaderReader #Attempting to remove the reliance on compiled packages. Switchin Mar345 reading to fabio.
 
 if RAWGlobals.isPY2:
@@ -63,25 +64,12 @@ except Exception as error:
     print(error)
     use_fabio = False
 
-    if RAWGlobals.compiled_extensions:
-        try:
-            import packc_ext
-            read_mar345=True
+    try:
+        import packc_ext
+        read_mar345 = True
 
-        except Exception as error1:
-                import SASbuild_Clibs
-                try:
-                    SASbuild_Clibs.buildAll()
-                    import packc_ext
-                    read_mar345=True
-
-                except Exception as error2:
-                    print(error2)
-                    RAWGlobals.compiled_extensions = False
-                    print('Unable to import fabio or pack_ext, Mar345 files cannot be opened.')
-                    read_mar345 = False
-    else:
-        print('Unable to import fabio or pack_ext, Mar345 files cannot be opened.')
+    except ImportError:
+        print('Unable to import fabio or packc_ext, Mar345 files cannot be opened.')
         read_mar345 = False
 
 
@@ -96,12 +84,41 @@ except Exception as error:
 # except Exception:
 #     print('ERROR Loading NeXus Library!')
 
-def createSASMFromImage(img_array, parameters = {}, x_c = None, y_c = None, mask = None,
-                        readout_noise_mask = None, tbs_mask = None, dezingering = 0, dezing_sensitivity = 4):
+def createSASMFromImage(img_array, parameters = None, x_c = None, y_c = None, mask = None,
+                        readout_noise_mask = None, tbs_mask = None, dezingering = 0, dezing_sensitivity = 4,
+                        geometry_cache = None, profile = None, dezing_spread = 'Std', workers = 1,
+                        dtype = np.float64, backend = 'Auto', q_edges = None, calibration = None,
+                        active_range = None, mode = 'Mean', clip_sigma = 3.0, clip_iterations = 5):
     '''
         Load measurement. Loads an image file, does pre-processing:
         masking, radial average and returns a measurement object
+
+        geometry_cache : SASImage.GeometryCache to reuse the integration
+                         geometry between images. Optional.
+        profile :        Already calculated [i, q, err] radial average of the
+                         image, e.g. from SASImage.radialAverageStack. Optional.
+        dezing_spread :  'Std' or 'MAD', the spread used to find zingers.
+        workers :        Number of threads used to integrate large images.
+        dtype :          Accumulation dtype of the radial average, np.float64
+                         or np.float32.
+        backend :        Integration backend name, or 'Auto' (see
+                         SASImage.integration_backends). The backend used and
+                         the integration time are stored in the 'integration'
+                         parameter of the measurement.
+        q_edges :        q-bin edges (1/A, see SASImage.calcQBinEdges) to
+                         integrate onto instead of pixel bins, needs
+                         calibration = (sd_distance, pixel_size, wavelength).
+                         The measurement is then already calibrated.
+        active_range :   (first_bin, last_bin) pixel bins that are integrated,
+                         see SASImage.calcActiveRange. The other points of
+                         the profile are 0. Optional.
+        mode :           'Mean', 'Median' or 'SigmaClip', the average of
+                         the pixels in each bin (see SASImage.integrateRobust).
+        clip_sigma, clip_iterations : Sigma clipping parameters.
     '''
+    if parameters is None:
+        parameters = {}
+
     if mask is not None:
         if mask.shape != img_array.shape:
             raise SASExceptions.MaskSizeError('Beamstop mask is the wrong size. Please' +
@@ -117,29 +134,146 @@ def createSASMFromImage(img_array, parameters = {}, x_c = None, y_c = None, mask
             raise SASExceptions.MaskSizeError('ROI Counter mask is the wrong size. Please' +
                             ' create a new mask or remove the old to make this plot.')
 
-    try:
-        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity)
-    except IndexError as msg:
-        print('Center coordinates too large: ' + str(msg))
+    if profile is not None:
+        i_raw, q_raw, err_raw = profile
+
+    elif q_edges is not None:
+        radius_edges = SASCalib.calcPixelsFromQ(q_edges, *calibration)
 
-        x_c = int(img_array.shape[1]/2)
-        y_c = int(img_array.shape[0]/2)
+        if geometry_cache is not None:
+            geometry = geometry_cache.getGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask,
+                                                  radius_edges = radius_edges)
+        else:
+            geometry = SASImage.RadialGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask,
+                                               radius_edges = radius_edges)
+
+        start = time.time()
+
+        i_raw, q_raw, err_raw = SASImage.radialAverageQ(img_array, geometry, calibration, workers = workers,
+                                                         dtype = dtype, mode = mode, clip_sigma = clip_sigma,
+                                                         clip_iterations = clip_iterations)
+
+        parameters['integration'] = {'backend'   : 'numpy',
+                                     'time'      : time.time() - start,
+                                     'q_binning' : len(q_edges) - 1}
+    else:
+        if geometry_cache is not None:
+            geometry = geometry_cache.getGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask,
+                                                  active_range = active_range)
+        else:
+            geometry = SASImage.RadialGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask,
+                                               active_range = active_range)
 
-        [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity)
+        benchmark = None
+
+        try:
+            # Pick the backend first, so timing the backends is not part of
+            # the integration time
+            if backend == 'Auto' and mode == 'Mean':
+                backend = SASImage.selectIntegrationBackend(img_array, geometry, workers, dtype)
+                benchmark = dict(geometry.backend_timings)
 
-        #wx.CallAfter(wx.MessageBox, "The center coordinates are too large for this image, used image center instead.",
-        # "Center coordinates does not fit image", wx.OK | wx.ICON_ERROR)
+            start = time.time()
+
+            [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity, geometry,
+                                                                      dezing_spread = dezing_spread, workers = workers, dtype = dtype,
+                                                                      backend = backend, mode = mode, clip_sigma = clip_sigma,
+                                                                      clip_iterations = clip_iterations)
+        except IndexError as msg:
+            print('Center coordinates too large: ' + str(msg))
+
+            x_c = int(img_array.shape[1]/2)
+            y_c = int(img_array.shape[0]/2)
+
+            geometry = SASImage.RadialGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask)
+
+            if backend == 'Auto':
+                backend = 'numpy'
+
+            benchmark = None
+
+            start = time.time()
+
+            [i_raw, q_raw, err_raw, qmatrix] = SASImage.radialAverage(img_array, x_c, y_c, mask, readout_noise_mask, dezingering, dezing_sensitivity, geometry,
+                                                                      dezing_spread = dezing_spread, workers = workers, dtype = dtype,
+                                                                      backend = backend, mode = mode, clip_sigma = clip_sigma,
+                                                                      clip_iterations = clip_iterations)
+
+            #wx.CallAfter(wx.MessageBox, "The center coordinates are too large for this image, used image center instead.",
+            # "Center coordinates does not fit image", wx.OK | wx.ICON_ERROR)
+
+        integration_time = time.time() - start
+
+        if mode != 'Mean':
+            parameters['integration'] = {'backend'   : 'numpy',
+                                         'time'      : integration_time}
+        else:
+            parameters['integration'] = {'backend'   : backend,
+                                         'time'      : integration_time}
+
+            if benchmark:
+                parameters['integration']['benchmark'] = benchmark
+
+    if mode != 'Mean' and profile is None:
+        parameters['integration']['mode'] = mode
 
     err_raw_non_nan = np.nan_to_num(err_raw)
 
     if tbs_mask is not None:
-        roi_counter = img_array[tbs_mask==1].sum()
+        roi_counter = SASImage.calcMaskedSum(img_array, tbs_mask)
         parameters['counters']['roi_counter'] = roi_counter
 
     sasm = SASM.SASM(i_raw, q_raw, err_raw_non_nan, parameters)
 
     return sasm
 
+def createCakeFromImage(img_array, parameters = None, x_c = None, y_c = None, mask = None,
+                        readout_noise_mask = None, chi_ranges = None, n_chi = 36, geometry_cache = None):
+    '''
+        Integrates an image in (q, chi) bins, using the same geometry as
+        the radial average. Returns the (n_q, n_chi) cake, its q and chi axes,
+        and a measurement object for each (chi_min, chi_max) sector in
+        chi_ranges (chi in degrees, see SASImage.radialAverageCake).
+    '''
+    if parameters is None:
+        parameters = {}
+
+    if mask is not None:
+        if mask.shape != img_array.shape:
+            raise SASExceptions.MaskSizeError('Beamstop mask is the wrong size. Please' +
+                            ' create a new mask or remove the old to make this plot.')
+
+    if readout_noise_mask is not None:
+        if readout_noise_mask.shape != img_array.shape:
+            raise SASExceptions.MaskSizeError('Readout-noise mask is the wrong size. Please' +
+                            ' create a new mask or remove the old to make this plot.')
+
+    if geometry_cache is not None:
+        geometry = geometry_cache.getGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask)
+    else:
+        geometry = SASImage.RadialGeometry(img_array.shape, x_c, y_c, mask, readout_noise_mask)
+
+    if chi_ranges is None:
+        chi_ranges = []
+
+    cake, q, chi, sectors = SASImage.radialAverageCake(img_array, geometry, n_chi, chi_ranges)
+
+    sasm_list = []
+
+    for chi_range, sector in zip(chi_ranges, sectors):
+        i_raw, q_raw, err_raw = sector
+
+        sector_parameters = copy.deepcopy(parameters)
+        sector_parameters['chi_range'] = list(chi_range)
+
+        if 'filename' in sector_parameters:
+            name, ext = os.path.splitext(sector_parameters['filename'])
+            sector_parameters['filename'] = name + '_chi%g_%g' %(chi_range[0], chi_range[1]) + ext
+
+        sasm_list.append(SASM.SASM(i_raw, q_raw, np.nan_to_num(err_raw), sector_parameters))
+
+    return cake, q, chi, sasm_list
+
 def loadMask(filename):
     ''' Loads a mask  '''
 
@@ -282,7 +416,7 @@ def loadFabio(filename):
         data = fabio_img.data
         hdr = fabio_img.getheader()
 
-        img[0] = data
+        img[0] = np.fliplr(data)
         img_hdr[0] = hdr
 
         for i in range(1,fabio_img.nframes):
@@ -319,7 +453,7 @@ def load32BitTiffImage(filename):
     try:
         im = Image.open(filename)
         if int(PIL.PILLOW_VERSION.split('.')[0])>2:
-            img = np.asarray(im, dtype=np.float)
+            img = np.array(im)
             # img = np.fromstring(im.tobytes(), np.uint32) #tobytes is compatible with pillow >=3.0, tostring was depreciated
         else:
             img = np.fromstring(im.tostring(), np.uint32)
@@ -431,97 +565,89 @@ def getMar345ImgDim(filename):
     return dim
 
 
-def loadFrelonImage(filename):
+def readEdfHeader(filename, max_size = 10000):
+    ''' Reads the header of an EDF (or FReLoN) file with a single read of
+    the first max_size bytes. Returns the header dictionary and the size of
+    the header, which is where the image data starts. '''
 
     with open(filename, 'rb') as fo:
+        data = fo.read(max_size)
 
-        ############## FIND HEADER LENGTH AND READ IMAGE ###########
-        fo.seek(0, 2)
-        eof = fo.tell()
-        fo.seek(0)
+    end = data.find(b'}')
 
-        hdr_size = 1
-        byte = None
-        while byte != '}' and hdr_size !=eof:
-            byte = fo.read(1)
-            hdr_size = hdr_size + 1
-            if hdr_size > 10000:
-                raise ValueError
+    if end == -1:
+        raise ValueError('No EDF header found in ' + filename)
 
-        ######################## PARSE HEADER ###################
-        fo.seek(0)
-        header = fo.read(hdr_size)
-        header = header.split('\n')
+    # The header ends with '}' and a newline
+    hdr_size = end + 2
 
-        header_dict = {}
-        for each in header:
-            sp_line = each.split('=')
+    header = data[:hdr_size].decode('latin-1').split('\n')
 
-            if sp_line[0].strip() == '{' or sp_line[0].strip() == '}' or sp_line[0].strip() == '':
-                continue
+    header_dict = {}
+    for each in header:
+        sp_line = each.split('=')
 
-            if len(sp_line) == 2:
-                header_dict[sp_line[0].strip()] = sp_line[1].strip()[:-2]
-            elif len>2:
-                header_dict[sp_line[0].strip()] = each[each.find('=')+2:-2]
+        if sp_line[0].strip() == '{' or sp_line[0].strip() == '}' or sp_line[0].strip() == '':
+            continue
 
-        #print(header_dict)
+        if len(sp_line) == 2:
+            header_dict[sp_line[0].strip()] = sp_line[1].strip()[:-2]
+        elif len(sp_line) > 2:
+            header_dict[sp_line[0].strip()] = each[each.find('=')+2:-2]
 
-        fo.seek(hdr_size)
+    return header_dict, hdr_size
 
-        dim1 = int(header_dict['Dim_1'])
-        dim2 = int(header_dict['Dim_2'])
+def loadEdfData(filename, dtype):
+    ''' Returns the header of an EDF file and the image as a read only
+    memory map of the file, so the pixels are read from the OS cache
+    when they are used instead of being copied into a new array. '''
 
-        img = np.fromfile(fo, dtype='<i2')
-        img = np.reshape(img, (dim1, dim2))
+    header_dict, hdr_size = readEdfHeader(filename)
 
-    img_hdr = header_dict
+    dim1 = int(header_dict['Dim_1'])
+    dim2 = int(header_dict['Dim_2'])
 
-    return img, img_hdr
+    img = np.memmap(filename, dtype = dtype, mode = 'r', offset = hdr_size, shape = (dim1, dim2))
+
+    return img, header_dict
+
+def loadFrelonImage(filename):
+
+    return loadEdfData(filename, '<i2')
 
 
 def loadIllSANSImage(filename):
+    ''' Loads an ILL SANS ascii image. The file is read once, the header and
+    image are located in the text and the image block is parsed with a
+    single call instead of line by line. '''
 
     with open(filename, 'r') as datafile:
-        all_lines = datafile.readlines()
-
+        text = datafile.read()
 
     ############################################
-    # Find image location:
-    lineidx = 0
-    header_idx = 0
-    image_found = False
-    for line in all_lines:
-
-        if len(line.split()) > 0:
-            if image_found and line.split()[0] == '16384':
-                break
+    # Find image location: the first line starting with 16384 after a line
+    # starting with I
+    image_match = re.search(r'^I[^\n]*\n[ \t]*16384(?=\s)[^\n]*(?:\n|$)', text, re.M)
 
-        if line[0] == 'I':
-            image_found = True
-        else:
-            image_found = False
+    if image_match is None:
+        raise ValueError('No image found in ' + filename)
 
-        try:
-            if line[0:10] == 'F'*10:
-                header_idx = lineidx
-        except Exception:
-            pass
+    # The header is after the last line starting with F*10 before the image
+    header_start = text.rfind('\n' + 'F'*10, 0, image_match.end())
 
-        lineidx = lineidx + 1
+    if header_start == -1:
+        raise ValueError('No header found in ' + filename)
     ##############################################
 
-    if header_idx == 0:
-        raise ValueError
-
-    header_idx = header_idx + 2 ## header starts 2 lines down
-
     no_header_lines = 25 # I dont know where to get this number.. 128 is written in the beginning.. but thats wrong
     no_header_colums = 5
 
+    # header starts 2 lines down
+    header_lines = text[header_start+1:image_match.start()].splitlines(True)[2:2*no_header_lines+3]
+
     hdr_labels = {}
     hdr_label_idx = 0
-    for each in all_lines[ header_idx : header_idx + no_header_lines + 1 ]:
+    for each in header_lines[ : no_header_lines + 1 ]:
         for col in range( 0, no_header_colums ):
             hdr_labels[ hdr_label_idx ] = each[ 16*col : 16*col + 16].lstrip().replace(' ', '_').replace('.', '_')
             hdr_label_idx += 1
@@ -529,19 +655,14 @@ def loadIllSANSImage(filename):
     hdr = {}
     ############ Read header values ###########
     hdr_label_idx = 0
-    for each in all_lines[ header_idx + no_header_lines + 1: header_idx + ( 2*no_header_lines ) + 1 ]:
+    for each in header_lines[ no_header_lines + 1 : 2*no_header_lines + 1 ]:
         for col in range( 0, no_header_colums ):
             hdr[hdr_labels[ hdr_label_idx ]] = float(each[ 16*col : 16*col + 16].lstrip())
             hdr_label_idx += 1
 
     hdr.pop('', None)
     ##################    READ IMAGE    ######################
-    datalines = all_lines[ lineidx + 1 : ]
-
-    data = np.array([])
-    for each_line in datalines:
-        ints = map(int, each_line.split())
-        data = np.append(data, ints)
+    data = np.fromstring(text[image_match.end():], dtype = float, sep = ' ')
 
     img = np.reshape(data, (128,128))
 
@@ -549,49 +670,20 @@ def loadIllSANSImage(filename):
 
 def loadEdfImage(filename):
 
-    with open(filename, 'rb') as fo:
-
-        ############## FIND HEADER LENGTH AND READ IMAGE ###########
-        fo.seek(0, 2)
-        eof = fo.tell()
-        fo.seek(0)
-
-        hdr_size = 1
-        byte = None
-        while byte != '}' and hdr_size !=eof:
-            byte = fo.read(1)
-            hdr_size = hdr_size + 1
-            if hdr_size > 10000:
-                raise ValueError
-
-        ######################## PARSE HEADER ###################
-        fo.seek(0)
-        header = fo.read(hdr_size)
-        header = header.split('\n')
-
-        header_dict = {}
-        for each in header:
-            sp_line = each.split('=')
-
-            if sp_line[0].strip() == '{' or sp_line[0].strip() == '}' or sp_line[0].strip() == '':
-                continue
-
-            if len(sp_line) == 2:
-                header_dict[sp_line[0].strip()] = sp_line[1].strip()[:-2]
-            elif len>2:
-                header_dict[sp_line[0].strip()] = each[each.find('=')+2:-2]
-
-        #print(header_dict)
+    return loadEdfData(filename, '<f4')
 
-        fo.seek(hdr_size)
+def loadNumpyImage(filename):
+    ''' Loads a 2D (or a stack of 2D) numpy .npy image as a read only memory
+    map, flipped left to right as when loaded with fabio. '''
 
-        dim1 = int(header_dict['Dim_1'])
-        dim2 = int(header_dict['Dim_2'])
+    data = np.load(filename, mmap_mode = 'r')
 
-        img = np.fromfile(fo, dtype='<f4')
-        img = np.reshape(img, (dim1, dim2))
-
-    img_hdr = header_dict
+    if data.ndim == 3:
+        img = [np.fliplr(frame) for frame in data]
+        img_hdr = [{} for frame in data]
+    else:
+        img = np.fliplr(data)
+        img_hdr = {}
 
     return img, img_hdr
 
@@ -639,6 +731,8 @@ def loadSAXSLAB300Image(filename):
 
 
 def loadMPAFile(filename):
+    ''' Loads an ascii MPA file. The file is read once, only the header
+    lines are split and each data block is parsed with a single call. '''
 
     header_prefix = ''
     data_prefix = ''
@@ -647,11 +741,16 @@ def loadMPAFile(filename):
     data ={}
 
     with open(filename, 'r') as fo:
-        lines = fo.readlines()
+        text = fo.read()
+
+    data_match = re.search(r'^\[(?:DATA|CDAT)', text, re.M)
 
+    if data_match is None:
+        raise ValueError('No data found in ' + filename)
 
-    for i in range(len(lines)):
-        line = lines[i]
+    pos = data_match.start()
+
+    for line in text[:pos].splitlines():
         if line.find('=') > -1:
             key = line.strip().split('=')[0]
             value = '='.join(line.strip().split('=')[1:])
@@ -662,26 +761,30 @@ def loadMPAFile(filename):
             else:
                 header[header_prefix][key] = value
 
-
         else:
-            if line.startswith('[DATA') or line.startswith('[CDAT'):
-                pos = i
-                break
-
-            else:
-                header_prefix = line.strip().strip('[]')
-                header[header_prefix] = {}
+            header_prefix = line.strip().strip('[]')
+            header[header_prefix] = {}
 
     if header['None']['mpafmt'] == 'asc':
-        while pos<len(lines):
-            line = lines[pos]
+        while pos < len(text) and text[pos:].strip() != '':
+            line_end = text.find('\n', pos)
+            if line_end == -1:
+                line_end = len(text)
+
+            data_prefix, num = text[pos:line_end].strip().strip('[]').split(',')
+
+            # Each block has one value per line and ends at the next [NAME,num] line
+            block_end = text.find('\n[', line_end)
+            if block_end == -1:
+                block_end = len(text)
+
+            data[data_prefix] = np.fromstring(text[line_end:block_end], dtype = float, sep = ' ')
 
-            data_prefix, num = line.strip().strip('[]').split(',')
-            # data_lines = np.array([float(fo.readline().strip()) for i in range(int(num))])
+            if data[data_prefix].size != int(num):
+                raise ValueError('Expected %s values in %s block of %s, found %i'
+                    %(num, data_prefix, filename, data[data_prefix].size))
 
-            data[data_prefix] = np.array(lines[pos+1:pos+int(num)+1],dtype=float)
-            # data[data_prefix] = np.array([float(j.strip()) for j in lines[i+1:i+int(num)+1]])
-            pos = pos+int(num)+1
+            pos = block_end + 1
     else:
         print('cannot recognize the mpa format %s' %(header['None']['mpafmt']))
         return
@@ -1380,7 +1483,7 @@ if use_fabio:
                        'MarCCD 165'         : loadFabio,
                        'Mar345'             : loadFabio,
                        'Medoptics'          : loadTiffImage,
-                       'Numpy 2D Array'     : loadFabio,
+                       'Numpy 2D Array'     : loadNumpyImage,
                        'Oxford Diffraction' : loadFabio,
                        'Pixi'               : loadFabio,
                        'Portable aNy Map'   : loadFabio,
@@ -1404,6 +1507,7 @@ else:
                        'SAXSLab300'             : loadSAXSLAB300Image,
                        'ESRF EDF'               : loadEdfImage,
                        'FReLoN'                 : loadFrelonImage,
+                       'Numpy 2D Array'         : loadNumpyImage,
                        '16 bit TIF'             : loadTiffImage,
                        '32 bit TIF'             : load32BitTiffImage,
                        # 'NeXus'                : loadNeXusFile,
@@ -1439,10 +1543,8 @@ def loadAllHeaders(filename, image_type, header_type, raw_settings):
     tbs_mask = masks['TransparentBSMask'][0]
 
     if tbs_mask is not None:
-        if isinstance(img, list):
-            roi_counter = img[tbs_mask==1].sum()
-        else:
-            roi_counter = img[0][tbs_mask==1].sum() #In the case of multiple images in the same file, load the ROI for the last one
+        #loadImage returns a list of frames, the header belongs to the first one
+        roi_counter = SASImage.calcMaskedSum(img[0], tbs_mask)
 
         if hdr is None:
             hdr = {'roi_counter': roi_counter}
@@ -1526,64 +1628,177 @@ def loadImage(filename, image_type):
 #--- ** MAIN LOADING FUNCTION **
 #################################
 
-def loadFile(filename, raw_settings, no_processing = False):
+def readImageAhead(filename, image_type):
+    ''' Reads an image file for prefetchImages. Returns (loaded_data,
+    loaded_hdr) as loadImage, or None if the file is not an image or can
+    not be read (loadFile then reads it again and reports the error).
+    Memory mapped images are only read when used, so the OS is asked to
+    read those files into its cache. '''
+
+    try:
+        if checkFileType(filename) != 'image':
+            return None
+
+        loaded_data, loaded_hdr = loadImage(filename, image_type)
+    except Exception:
+        return None
+
+    if hasattr(os, 'posix_fadvise') and any(isinstance(frame, np.memmap) for frame in loaded_data):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    return loaded_data, loaded_hdr
+
+def prefetchImages(filename_list, image_type, depth = 2, max_bytes = 0):
+    ''' Yields (filename, loaded_image) for the files in filename_list, in
+    order, while the next files are read on background threads. loaded_image
+    is from readImageAhead, to be passed to loadFile.
+
+    depth :      Number of files read ahead of the current one
+    max_bytes :  Largest total size of the files read ahead, 0 for no limit.
+                 The file that is needed next is always read.
+    '''
+
+    pool = multiprocessing.pool.ThreadPool(max(depth, 1))
+
+    pending = collections.deque()
+    pending_bytes = 0
+    next_idx = 0
+
+    try:
+        for filename in filename_list:
+            while next_idx < len(filename_list) and len(pending) <= depth:
+                try:
+                    size = os.path.getsize(filename_list[next_idx])
+                except OSError:
+                    size = 0
+
+                if pending and max_bytes > 0 and pending_bytes + size > max_bytes:
+                    break
+
+                result = pool.apply_async(readImageAhead, (filename_list[next_idx], image_type))
+
+                pending.append((size, result))
+                pending_bytes += size
+                next_idx += 1
+
+            size, result = pending.popleft()
+            pending_bytes -= size
+
+            yield filename, result.get()
+    finally:
+        pool.terminate()
+
+def loadFile(filename, raw_settings, no_processing = False, geometry_cache = None, loaded_image = None):
     ''' Loads a file an returns a SAS Measurement Object (SASM) and the full image if the
         selected file was an Image file
 
          NB: This is the function used to load any type of file in RAW
+
+         geometry_cache: SASImage.GeometryCache shared between calls, so the
+                         integration geometry is only built once per run.
+         loaded_image:   (loaded_data, loaded_hdr) already read from the file,
+                         e.g. by prefetchImages. Optional.
+    '''
+    if loaded_image is not None:
+        file_type = 'image'
+    else:
+        try:
+            file_type = checkFileType(filename)
+            # print(file_type)
+        except IOError:
+            raise
+        except Exception as msg:
+            print(str(msg), file=sys.stderr)
+            file_type = None
+
+    if file_type == 'image':
+        try:
+            sasm, img = loadImageFile(filename, raw_settings, geometry_cache, loaded_image)
+        except (ValueError, AttributeError) as msg:
+            print('SASFileIO.loadFile : ' + str(msg))
+            raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
+
+        sasm = processImageSasm(sasm, img, raw_settings, no_processing)
+
+    else:
+        sasm = loadAsciiFile(filename, file_type)
+        img = None
+
+        #If you don't want to post process asci files, return them as a list
+        if type(sasm) != list:
+            SASM.postProcessSasm(sasm, raw_settings)
+
+    if type(sasm) != list and (sasm is None or len(sasm.i) == 0):
+        raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
+
+    return sasm, img
+
+def iterFile(filename, raw_settings, no_processing = False, geometry_cache = None):
+    ''' Streaming version of loadFile. Yields (sasm, img) for every frame of
+    an image file as soon as it is integrated, calibrated and post
+    processed, so the frames can be discarded one at a time (see
+    iterImageFile). Other files are loaded with loadFile and yielded once.
     '''
+
     try:
         file_type = checkFileType(filename)
-        # print(file_type)
     except IOError:
         raise
     except Exception as msg:
         print(str(msg), file=sys.stderr)
         file_type = None
 
-    if file_type == 'image':
+    if file_type != 'image':
+        yield loadFile(filename, raw_settings, no_processing, geometry_cache)
+        return
+
+    frames = iterImageFile(filename, raw_settings, geometry_cache)
+
+    while True:
         try:
-            sasm, img = loadImageFile(filename, raw_settings)
+            sasm, img = next(frames)
+        except StopIteration:
+            return
         except (ValueError, AttributeError) as msg:
-            print('SASFileIO.loadFile : ' + str(msg))
+            print('SASFileIO.iterFile : ' + str(msg))
             raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
 
-        if not RAWGlobals.usepyFAI_integration:
-            try:
-                sasm = SASImage.calibrateAndNormalize(sasm, img, raw_settings)
-            except (ValueError, NameError) as msg:
-                print(msg)
+        sasm = processImageSasm(sasm, img, raw_settings, no_processing)[0]
 
-        #Always do some post processing for image files
-        if type(sasm) == list:
-            for current_sasm in sasm:
+        if len(sasm.i) == 0:
+            raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
 
-                current_sasm.setParameter('config_file', raw_settings.get('CurrentCfg'))
+        yield sasm, img
 
-                SASM.postProcessSasm(current_sasm, raw_settings)
+def processImageSasm(sasm, img, raw_settings, no_processing = False):
+    ''' Calibrates, normalizes and post processes the sasm (or list of sasms)
+    integrated from img, as done by loadFile. Returns a list of sasms. '''
 
-                if not no_processing:
-                    SASM.postProcessImageSasm(current_sasm, raw_settings)
-        else:
-            sasm.setParameter('config_file', raw_settings.get('CurrentCfg'))
+    if type(sasm) != list:
+        sasm = [sasm]
+        img = [img]
 
-            SASM.postProcessSasm(sasm, raw_settings)
+    if not RAWGlobals.usepyFAI_integration:
+        try:
+            sasm = SASImage.calibrateAndNormalize(sasm, img, raw_settings)
+        except (ValueError, NameError) as msg:
+            print(msg)
 
-            if not no_processing:
-                SASM.postProcessImageSasm(sasm, raw_settings)
+    #Always do some post processing for image files
+    for current_sasm in sasm:
 
-    else:
-        sasm = loadAsciiFile(filename, file_type)
-        img = None
+        current_sasm.setParameter('config_file', raw_settings.get('CurrentCfg'))
 
-        #If you don't want to post process asci files, return them as a list
-        if type(sasm) != list:
-            SASM.postProcessSasm(sasm, raw_settings)
+        SASM.postProcessSasm(current_sasm, raw_settings)
 
-    if type(sasm) != list and (sasm is None or len(sasm.i) == 0):
-        raise SASExceptions.UnrecognizedDataFormat('No data could be retrieved from the file, unknown format.')
+        if not no_processing:
+            SASM.postProcessImageSasm(current_sasm, raw_settings)
 
-    return sasm, img
+    return sasm
 
 def loadAsciiFile(filename, file_type):
     ascii_formats = {'rad'        : loadRadFile,
@@ -1626,128 +1841,298 @@ def loadAsciiFile(filename, file_type):
     return sasm
 
 
-def loadImageFile(filename, raw_settings):
+def getActiveRange(raw_settings, img_dim, x_c, y_c):
+    ''' Returns the pixel bins of the radial average that fall in the q
+    range selected with StartPoint and EndPoint (see
+    SASImage.calcActiveRange), so only those are integrated.
+
+    Zinger removal (SASM.removeZingers) checks the whole profile from
+    ZingerRemoveIdx on, against the points before each one, so with it on
+    the range starts at ZingerRemoveIdx at the latest. '''
+
+    start_point = raw_settings.get('StartPoint')
+
+    if raw_settings.get('ZingerRemoval'):
+        start_point = min(start_point, raw_settings.get('ZingerRemoveIdx'))
+
+    return SASImage.calcActiveRange(SASImage.calcMaxRadius(img_dim, x_c, y_c),
+                                    raw_settings.get('Binsize'),
+                                    start_point,
+                                    raw_settings.get('EndPoint'))
+
+def getFrameName(filename, frame_idx, n_frames):
+    ''' Returns the name of frame frame_idx of the image file filename,
+    with _00000 style frame numbers for multi-frame files. '''
+
+    if n_frames > 1:
+        temp_filename = os.path.split(filename)[1].split('.')
+        if len(temp_filename) > 1:
+            temp_filename[-2] = temp_filename[-2] + '_%05i' %(frame_idx)
+        else:
+            temp_filename[0] = temp_filename[0] + '_%05i' %(frame_idx)
+
+        return '.'.join(temp_filename)
+    else:
+        return os.path.split(filename)[1]
+
+def iterImageFrames(filename, image_type):
+    ''' Yields (frame, header, frame_name) for each frame of an image file.
+    Frames read with fabio (e.g. Eiger HDF5 or multi-frame EDF) are read one
+    at a time, so only the current frame is kept in memory. The other
+    loaders read the whole file first (.npy stacks are memory mapped). '''
+
+    if use_fabio and all_image_types.get(image_type) is loadFabio:
+        try:
+            fabio_img = fabio.open(filename)
+        except Exception as msg:
+            raise SASExceptions.WrongImageFormat('Error loading image, ' + str(msg))
+
+        n_frames = fabio_img.nframes
+
+        for i in range(n_frames):
+            if i > 0:
+                fabio_img = fabio_img.next()
+
+            yield np.fliplr(fabio_img.data), fabio_img.getheader(), getFrameName(filename, i, n_frames)
+
+            # Multi-frame containers (e.g. EDF) keep the data of every frame
+            # that was read in their frame list, drop the frame that was used
+            frames = getattr(fabio_img, '_frames', None)
+            if frames is not None and len(frames) == n_frames:
+                frames[fabio_img.currentframe].data = None
+
+    else:
+        loaded_data, loaded_hdr = loadImage(filename, image_type)
+
+        for i in range(len(loaded_data)):
+            yield loaded_data[i], loaded_hdr[i], getFrameName(filename, i, len(loaded_data))
+
+def loadFlatfield(raw_settings):
+    ''' Returns the averaged flatfield image and its header file info, or
+    None if flatfield correction is not used. '''
+
+    flatfield_filename = raw_settings.get('NormFlatfieldFile')
+
+    if not raw_settings.get('NormFlatfieldEnabled') or flatfield_filename is None:
+        return None
+
+    flatfield_img, flatfield_img_hdr = loadImage(flatfield_filename, raw_settings.get('ImageFormat'))
+    flatfield_hdr = loadHeader(flatfield_filename, flatfield_filename, raw_settings.get('ImageHdrFormat'))
+    flatfield_img = np.average(flatfield_img, axis=0)
+
+    return flatfield_img, flatfield_hdr
+
+def loadImageFile(filename, raw_settings, geometry_cache = None, loaded_image = None):
 
     img_fmt = raw_settings.get('ImageFormat')
-    hdr_fmt = raw_settings.get('ImageHdrFormat')
 
-    loaded_data, loaded_hdr = loadImage(filename, img_fmt)
+    if loaded_image is not None:
+        loaded_data, loaded_hdr = loaded_image
+    else:
+        loaded_data, loaded_hdr = loadImage(filename, img_fmt)
 
     sasm_list = [None for i in range(len(loaded_data))]
 
     #Pre-load the flatfield file, so it's not loaded every time
-    if raw_settings.get('NormFlatfieldEnabled'):
-        flatfield_filename = raw_settings.get('NormFlatfieldFile')
-        if flatfield_filename is not None:
-            flatfield_img, flatfield_img_hdr = loadImage(flatfield_filename, img_fmt)
-            flatfield_hdr = loadHeader(flatfield_filename, flatfield_filename, hdr_fmt)
-            flatfield_img = np.average(flatfield_img, axis=0)
+    flatfield = loadFlatfield(raw_settings)
 
-    #Process all loaded images into sasms
-    for i in range(len(loaded_data)):
-        img = loaded_data[i]
-        img_hdr = loaded_hdr[i]
+    #Integrate all frames of a multi-frame file together, if they share the same
+    #center and masks (no per frame header values, flatfield or dezingering)
+    stack_profiles = None
+
+    if (len(loaded_data) > 1 and not RAWGlobals.usepyFAI_integration
+        and raw_settings.get('IntegrationBackend') == 'Auto'
+        and raw_settings.get('QBinning') == 'Pixel'
+        and raw_settings.get('IntegrationMode') == 'Mean'
+        and not raw_settings.get('ZingerRemovalRadAvg')
+        and not raw_settings.get('UseHeaderForCalib')
+        and not (raw_settings.get('UseHeaderForMask') and img_fmt == 'SAXSLab300')
+        and not raw_settings.get('NormFlatfieldEnabled')):
+
+        img_shape = loaded_data[0].shape
+
+        masks = raw_settings.get('Masks')
+        bs_mask = masks['BeamStopMask'][0]
+        dc_mask = masks['ReadOutNoiseMask'][0]
 
-        if len(loaded_data) > 1:
-            temp_filename = os.path.split(filename)[1].split('.')
-            if len(temp_filename) > 1:
-                temp_filename[-2] = temp_filename[-2] + '_%05i' %(i)
+        same_shape = all(img.shape == img_shape for img in loaded_data)
+        masks_fit = all(each_mask is None or each_mask.shape == img_shape for each_mask in (bs_mask, dc_mask))
+
+        if same_shape and masks_fit:
+            x_c = raw_settings.get('Xcenter')
+            y_c = img_shape[0] - raw_settings.get('Ycenter')
+
+            active_range = getActiveRange(raw_settings, img_shape, x_c, y_c)
+
+            if geometry_cache is not None:
+                geometry = geometry_cache.getGeometry(img_shape, x_c, y_c, bs_mask, dc_mask,
+                                                      active_range = active_range)
             else:
-                temp_filename[0] = temp_filename[0] + '_%05i' %(i)
+                geometry = SASImage.RadialGeometry(img_shape, x_c, y_c, bs_mask, dc_mask,
+                                                   active_range = active_range)
+
+            start = time.time()
 
-            new_filename = '.'.join(temp_filename)
+            stack_profiles = SASImage.radialAverageStack(loaded_data, geometry)
+
+            stack_time = (time.time() - start) / len(loaded_data)
+
+    #Process all loaded images into sasms
+    for i in range(len(loaded_data)):
+        if stack_profiles is not None:
+            stack_i, stack_q, stack_err = stack_profiles
+            stack_profile = ([stack_i[i], stack_q, stack_err[i]], stack_time)
         else:
-            new_filename = os.path.split(filename)[1]
+            stack_profile = None
 
-        hdrfile_info = loadHeader(filename, new_filename, hdr_fmt)
+        sasm_list[i] = processImageFrame(loaded_data[i], loaded_hdr[i], filename,
+                                         getFrameName(filename, i, len(loaded_data)), raw_settings,
+                                         geometry_cache, flatfield, stack_profile)
 
-        parameters = {'imageHeader' : img_hdr,
-                      'counters'    : hdrfile_info,
-                      'filename'    : new_filename,
-                      'load_path'   : filename}
+    return sasm_list, loaded_data
 
-        for key in parameters['counters']:
-            if key.lower().find('concentration') > -1 or key.lower().find('mg/ml') > -1:
-                parameters['Conc'] = parameters['counters'][key]
-                break
+def iterImageFile(filename, raw_settings, geometry_cache = None):
+    ''' Streaming version of loadImageFile. Yields (sasm, img) for one frame
+    of the file at a time, so a long multi-frame series can be integrated
+    without holding all frames in memory (see iterImageFrames). The frames
+    are integrated one by one, not as a stack. '''
 
-        x_c = raw_settings.get('Xcenter')
-        y_c = raw_settings.get('Ycenter')
+    flatfield = loadFlatfield(raw_settings)
 
-        ## Read center coordinates from header?
-        if raw_settings.get('UseHeaderForCalib'):
-            try:
-                x_y = SASImage.getBindListDataFromHeader(raw_settings, img_hdr, hdrfile_info, keys = ['Beam X Center', 'Beam Y Center'])
+    for img, img_hdr, new_filename in iterImageFrames(filename, raw_settings.get('ImageFormat')):
+        sasm = processImageFrame(img, img_hdr, filename, new_filename, raw_settings, geometry_cache, flatfield)
 
-                if x_y[0] is not None: x_c = x_y[0]
-                if x_y[1] is not None: y_c = x_y[1]
-            except ValueError:
-                pass
-            except TypeError:
-                raise SASExceptions.HeaderLoadError('Error loading header, file corrupt?')
-
-        # ********************
-        # If the file is a SAXSLAB file, then get mask parameters from the header and modify the mask
-        # then apply it...
-        #
-        # Mask should be not be changed, but should be created here. If no mask information is found, then
-        # use the user created mask. There should be a force user mask setting.
-        #
-        # ********************
+        yield sasm, img
 
-        masks = raw_settings.get('Masks')
+def processImageFrame(img, img_hdr, filename, new_filename, raw_settings, geometry_cache = None,
+                      flatfield = None, stack_profile = None):
+    ''' Integrates one image frame into a sasm, with the settings of
+    loadImageFile. flatfield is from loadFlatfield, stack_profile is
+    ([i, q, err], time per frame) when the frame was already integrated
+    with SASImage.radialAverageStack. '''
 
-        use_hdr_mask = raw_settings.get('UseHeaderForMask')
+    img_fmt = raw_settings.get('ImageFormat')
+    hdr_fmt = raw_settings.get('ImageHdrFormat')
 
-        if use_hdr_mask and img_fmt == 'SAXSLab300':
-            try:
-                mask_patches = SASImage.createMaskFromHdr(img, img_hdr, flipped = raw_settings.get('DetectorFlipped90'))
-                bs_mask_patches = masks['BeamStopMask'][1]
+    hdrfile_info = loadHeader(filename, new_filename, hdr_fmt)
 
-                if bs_mask_patches is not None:
-                    all_mask_patches = mask_patches + bs_mask_patches
-                else:
-                    all_mask_patches = mask_patches
+    parameters = {'imageHeader' : img_hdr,
+                  'counters'    : hdrfile_info,
+                  'filename'    : new_filename,
+                  'load_path'   : filename}
 
-                bs_mask = SASImage.createMaskMatrix(img.shape, all_mask_patches)
-            except KeyError:
-                raise SASExceptions.HeaderMaskLoadError('bsmask_configuration not found in header.')
+    for key in parameters['counters']:
+        if key.lower().find('concentration') > -1 or key.lower().find('mg/ml') > -1:
+            parameters['Conc'] = parameters['counters'][key]
+            break
 
-            dc_mask = masks['ReadOutNoiseMask'][0]
-        else:
-            bs_mask = masks['BeamStopMask'][0]
-            dc_mask = masks['ReadOutNoiseMask'][0]
+    x_c = raw_settings.get('Xcenter')
+    y_c = raw_settings.get('Ycenter')
 
+    ## Read center coordinates from header?
+    if raw_settings.get('UseHeaderForCalib'):
+        try:
+            x_y = SASImage.getBindListDataFromHeader(raw_settings, img_hdr, hdrfile_info, keys = ['Beam X Center', 'Beam Y Center'])
 
-        tbs_mask = masks['TransparentBSMask'][0]
+            if x_y[0] is not None: x_c = x_y[0]
+            if x_y[1] is not None: y_c = x_y[1]
+        except ValueError:
+            pass
+        except TypeError:
+            raise SASExceptions.HeaderLoadError('Error loading header, file corrupt?')
+
+    # ********************
+    # If the file is a SAXSLAB file, then get mask parameters from the header and modify the mask
+    # then apply it...
+    #
+    # Mask should be not be changed, but should be created here. If no mask information is found, then
+    # use the user created mask. There should be a force user mask setting.
+    #
+    # ********************
 
-        # ********* WARNING WARNING WARNING ****************#
-        # Hmm.. axes start from the lower left, but array coords starts
-        # from upper left:
-        #####################################################
-        y_c = img.shape[0]-y_c
+    masks = raw_settings.get('Masks')
 
-        if not RAWGlobals.usepyFAI_integration:
-            # print('Using standard RAW integration')
-            ## Flatfield correction.. this part gets moved to a image correction function later
-            if raw_settings.get('NormFlatfieldEnabled'):
-                if flatfield_filename is not None:
-                    img, img_hdr = SASImage.doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr)
-                else:
-                    pass #Raise some error
+    use_hdr_mask = raw_settings.get('UseHeaderForMask')
 
-            dezingering = raw_settings.get('ZingerRemovalRadAvg')
-            dezing_sensitivity = raw_settings.get('ZingerRemovalRadAvgStd')
+    if use_hdr_mask and img_fmt == 'SAXSLab300':
+        try:
+            bs_mask = SASImage.createMaskMatrixFromHdr(img, img_hdr, flipped = raw_settings.get('DetectorFlipped90'),
+                                                       user_masks = masks['BeamStopMask'][1])
+        except KeyError:
+            raise SASExceptions.HeaderMaskLoadError('bsmask_configuration not found in header.')
 
-            sasm = createSASMFromImage(img, parameters, x_c, y_c, bs_mask, dc_mask, tbs_mask, dezingering, dezing_sensitivity)
+        dc_mask = masks['ReadOutNoiseMask'][0]
+    else:
+        bs_mask = masks['BeamStopMask'][0]
+        dc_mask = masks['ReadOutNoiseMask'][0]
 
-        else:
-            sasm = SASImage.pyFAIIntegrateCalibrateNormalize(img, parameters, x_c, y_c, raw_settings, bs_mask, tbs_mask)
 
-        sasm_list[i] = sasm
+    tbs_mask = masks['TransparentBSMask'][0]
 
+    # ********* WARNING WARNING WARNING ****************#
+    # Hmm.. axes start from the lower left, but array coords starts
+    # from upper left:
+    #####################################################
+    y_c = img.shape[0]-y_c
 
-    return sasm_list, loaded_data
+    if stack_profile is not None:
+        profile, stack_time = stack_profile
+
+        parameters['integration'] = {'backend' : 'stack', 'time' : stack_time}
+
+        sasm = createSASMFromImage(img, parameters, x_c, y_c, bs_mask, dc_mask, tbs_mask,
+                                   profile = profile)
+
+    elif not RAWGlobals.usepyFAI_integration:
+        # print('Using standard RAW integration')
+        ## Flatfield correction.. this part gets moved to a image correction function later
+        if raw_settings.get('NormFlatfieldEnabled'):
+            if flatfield is not None:
+                flatfield_img, flatfield_hdr = flatfield
+                img, img_hdr = SASImage.doFlatfieldCorrection(img, img_hdr, flatfield_img, flatfield_hdr)
+            else:
+                pass #Raise some error
+
+        dezingering = raw_settings.get('ZingerRemovalRadAvg')
+        dezing_sensitivity = raw_settings.get('ZingerRemovalRadAvgStd')
+        dezing_spread = raw_settings.get('ZingerRemovalRadAvgSpread')
+
+        q_binning = raw_settings.get('QBinning')
+
+        if q_binning != 'Pixel' and raw_settings.get('CalibrateMan'):
+            calibration = SASImage.getCalibration(raw_settings, img_hdr, hdrfile_info)
+
+            q_min = raw_settings.get('QBinMin')
+            q_max = raw_settings.get('QBinMax')
+
+            if q_min <= 0:
+                q_min = SASCalib.calcQFromPixels(1, *calibration) if q_binning == 'Log' else 0.0
+            if q_max <= 0:
+                q_max = SASCalib.calcQFromPixels(SASImage.calcMaxRadius(img.shape, x_c, y_c), *calibration)
+
+            q_edges = SASImage.calcQBinEdges(q_min, q_max, raw_settings.get('QBinNumber'), q_binning)
+            active_range = None
+        else:
+            calibration = None
+            q_edges = None
+            active_range = getActiveRange(raw_settings, img.shape, x_c, y_c)
+
+        sasm = createSASMFromImage(img, parameters, x_c, y_c, bs_mask, dc_mask, tbs_mask, dezingering, dezing_sensitivity,
+                                   geometry_cache, dezing_spread = dezing_spread,
+                                   workers = raw_settings.get('IntegrationWorkers'),
+                                   dtype = np.float32 if raw_settings.get('IntegrationFloat32') else np.float64,
+                                   backend = raw_settings.get('IntegrationBackend'),
+                                   q_edges = q_edges, calibration = calibration,
+                                   active_range = active_range,
+                                   mode = raw_settings.get('IntegrationMode'),
+                                   clip_sigma = raw_settings.get('IntegrationClipSigma'),
+                                   clip_iterations = raw_settings.get('IntegrationClipIterations'))
+
+    else:
+        sasm = SASImage.pyFAIIntegrateCalibrateNormalize(img, parameters, x_c, y_c, raw_settings, bs_mask, tbs_mask,
+                                                         geometry_cache)
+
+    return sasm
 
 
 def loadOutFile(filename):
@@ -26,7 +26,9 @@ from __future__ import print_function, division  # TODO: check whether true divi
 
 import numpy as np
 from scipy import optimize
-import os, sys, math  # wx
+import scipy.sparse
+import os, sys, math, time, hashlib, collections  # wx
+import multiprocessing.pool
 
 RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
@@ -40,20 +42,9 @@ try:
 except Exception:
     RAWGlobals.usepyFAI = False
 
-# If C extensions have not been built, build them:
+# Compiled extensions are built with SASbuild_Clibs.py, ravg_python is used otherwise
 if RAWGlobals.compiled_extensions:
-    try:
-        import ravg_ext
-
-    except ImportError:
-        import SASbuild_Clibs
-        try:
-            SASbuild_Clibs.buildAll()
-            import ravg_ext
-
-        except Exception as error:
-            RAWGlobals.compiled_extensions = False
-            print(error)
+    import ravg_ext
 
 
 class Mask:
@@ -95,6 +86,22 @@ class Mask:
     def getFillPoints(self):
         pass    # overridden when inherited
 
+    def getFillMatrix(self, img_dim):
+        ''' Returns a boolean matrix of size img_dim which is True at the
+        fill points of the mask that lie inside the image '''
+
+        fill = np.zeros(img_dim, dtype = bool)
+
+        points = np.array(self.getFillPoints(), dtype = np.float64).reshape(-1, 2)
+
+        inside = ((points[:,0] >= 0) & (points[:,0] < img_dim[0]) &
+                  (points[:,1] >= 0) & (points[:,1] < img_dim[1]))
+
+        points = points[inside].astype(int)
+        fill[points[:,0], points[:,1]] = True
+
+        return fill
+
 class CircleMask(Mask):
     ''' Create a circular mask '''
 
@@ -171,6 +178,37 @@ class CircleMask(Mask):
 
         return fillPoints
 
+    def getFillMatrix(self, img_dim):
+        ''' Fills the same pixels as getFillPoints, one row span and one
+        column span at a time for each step of the Bresenham circle '''
+
+        fill = np.zeros(img_dim, dtype = bool)
+        maxx, maxy = img_dim
+
+        radiusC = abs(self._points[1][0] - self._points[0][0])
+
+        P = calcBresenhamCirclePoints(radiusC, self._points[0][1], self._points[0][0])
+
+        for i in range(0, int(len(P)/8) ):
+            Pp = P[i*8 : i*8 + 8]
+
+            start = int(Pp[1][1])
+            stop = int(Pp[0][1]+1)
+            length = max(stop - start, 0)
+
+            for row in (Pp[0][0], Pp[2][0]):
+                if row >= 0 and row < maxx:
+                    fill[int(row), max(start, 0):max(stop, 0)] = True
+
+            for col, start, stop in ((Pp[4][1], int(Pp[6][0]), int(Pp[4][0]+1)),
+                                     (Pp[5][1], int(Pp[7][0]), int(Pp[5][0]+1))):
+                stop = min(stop, start + length)
+
+                if col >= 0 and col < maxy:
+                    fill[max(start, 0):max(stop, 0), int(col)] = True
+
+        return fill
+
 class RectangleMask(Mask):
     ''' create a retangular mask '''
 
@@ -245,6 +283,18 @@ class RectangleMask(Mask):
 
         return fillPoints
 
+    def getFillMatrix(self, img_dim):
+
+        start_point, end_point = self._points
+
+        row_start, row_end = sorted([int(start_point[1]), int(end_point[1])])
+        col_start, col_end = sorted([int(start_point[0]), int(end_point[0])])
+
+        fill = np.zeros(img_dim, dtype = bool)
+        fill[max(row_start, 0):max(row_end + 1, 0), max(col_start, 0):max(col_end + 1, 0)] = True
+
+        return fill
+
 class PolygonMask(Mask):
     ''' create a polygon mask '''
 
@@ -256,25 +306,27 @@ class PolygonMask(Mask):
 
     def getFillPoints(self):
 
-        proper_formatted_points = []
         yDim, xDim = self._img_dimension
 
-        for each in self._points:
-            proper_formatted_points.append(list(each))
+        cols, rows = np.nonzero(self.getFillMatrix((yDim, xDim)).T)
 
-        proper_formatted_points = np.array(proper_formatted_points)
+        return list(zip(rows, cols))
 
-        pb = polymask.Polygeom(proper_formatted_points)
+    def getFillMatrix(self, img_dim):
+        ''' Rasterizes the polygon over its bounding box, limited to the
+        image dimension the mask was made for '''
 
-        grid = np.mgrid[0:xDim,0:yDim].reshape(2,-1).swapaxes(0,1)
+        yDim, xDim = self._img_dimension
 
-        inside = pb.inside(grid)
+        pb = polymask.Polygeom(np.array([list(each) for each in self._points]))
 
-        p = np.where(inside==True)
+        rows = min(yDim, img_dim[0])
+        cols = min(xDim, img_dim[1])
 
-        coords = polymask.getCoords(p, (yDim, xDim))
+        fill = np.zeros(img_dim, dtype = bool)
+        fill[:rows, :cols] = pb.rasterize((rows, cols))
 
-        return coords
+        return fill
 
 
 def calcExpression(expr, img_hdr, file_hdr):
@@ -336,17 +388,29 @@ def getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys):
     return result
 
 
-def calibrateAndNormalize(sasm_list, img_list, raw_settings):
-    # Calibrate Q
+def getCalibration(raw_settings, img_hdr = None, file_hdr = None):
+    ''' Returns (sd_distance, pixel_size, wavelength) used to calibrate q,
+    with the pixel size in mm. With UseHeaderForCalib the values bound to
+    the image and file headers are used when they are found. '''
+
     sd_distance = raw_settings.get('SampleDistance')
-    pixel_size = raw_settings.get('DetectorPixelSize')
+    pixel_size = raw_settings.get('DetectorPixelSize') / 1000.0
     wavelength = raw_settings.get('WaveLength')
+
+    if raw_settings.get('UseHeaderForCalib'):
+        result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
+        if result[0] is not None: sd_distance = result[0]
+        if result[1] is not None: pixel_size = result[1]
+        if result[2] is not None: wavelength = result[2]
+
+    return sd_distance, pixel_size, wavelength
+
+def calibrateAndNormalize(sasm_list, img_list, raw_settings):
+    # Calibrate Q
     bin_size = raw_settings.get('Binsize')
     calibrate_check = raw_settings.get('CalibrateMan')
     enable_normalization = raw_settings.get('EnableNormalization')
 
-    pixel_size = pixel_size / 1000.0
-
     if type(sasm_list) != list:
         sasm_list = [sasm_list]
         img_list = [img_list]
@@ -355,24 +419,30 @@ def calibrateAndNormalize(sasm_list, img_list, raw_settings):
         sasm = sasm_list[i]
         img = img_list[i]
 
-        if raw_settings.get('UseHeaderForCalib'):
-            img_hdr = sasm.getParameter('imageHeader')
-            file_hdr = sasm.getParameter('counters')
+        sd_distance, pixel_size, wavelength = getCalibration(raw_settings, sasm.getParameter('imageHeader'),
+                                                             sasm.getParameter('counters'))
 
-            result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
-            if result[0] is not None: sd_distance = result[0]
-            if result[1] is not None: pixel_size = result[1]
-            if result[2] is not None: wavelength = result[2]
+        # Profiles integrated onto q-bins (see radialAverageQ) are already
+        # binned and calibrated
+        integration = sasm.getParameter('integration')
+        q_binned = integration is not None and 'q_binning' in integration
 
         if raw_settings.get('DoSolidAngleCorrection'):
-            sc = SASCalib.calcSolidAngleCorrection(sasm, sd_distance, pixel_size)
+            if q_binned:
+                sc = SASCalib.calcSolidAngleCorrectionFromQ(sasm.getBinnedQ(), wavelength)
 
-            sasm.scaleRawIntensity(1.0/sc)
+                sasm.scaleRawIntensity(1.0/sc)
+                sasm.scaleBinnedIntensity(1.0/sc)
+            else:
+                sc = SASCalib.calcSolidAngleCorrection(sasm, sd_distance, pixel_size)
+
+                sasm.scaleRawIntensity(1.0/sc)
 
-        sasm.setBinning(bin_size)
+        if not q_binned:
+            sasm.setBinning(bin_size)
 
-        if calibrate_check:
-            sasm.calibrateQ(sd_distance, pixel_size, wavelength)
+            if calibrate_check:
+                sasm.calibrateQ(sd_distance, pixel_size, wavelength)
 
         normlist = raw_settings.get('NormalizationList')
         img_hdr = sasm.getParameter('imageHeader')
@@ -684,8 +754,8 @@ def calcBresenhamCirclePoints(radius, xOffset = 0, yOffset = 0):
     return points
 
 def createMaskMatrix(img_dim, masks):
-    ''' creates a 2D binary matrix of the same size as the image,
-    corresponding to the mask pattern '''
+    ''' creates a 2D boolean matrix of the same size as the image,
+    corresponding to the mask pattern (True for the pixels to use) '''
 
     negmasks = []
     posmasks = []
@@ -698,37 +768,151 @@ def createMaskMatrix(img_dim, masks):
         else:
             posmasks.append(each)
 
+    #With negative masks the image starts masked, negative masks are
+    #opened up first and the positive masks are applied on top
     if neg:
-        for each in posmasks:
-            negmasks.append(each)
-
-            masks = negmasks
-        mask = np.zeros(img_dim)
+        masks = negmasks + posmasks
+        mask = np.zeros(img_dim, dtype = bool)
     else:
-        mask = np.ones(img_dim)
-
-    maxy = mask.shape[1]
-    maxx = mask.shape[0]
+        mask = np.ones(img_dim, dtype = bool)
 
     for each in masks:
-        fillPoints = each.getFillPoints()
+        fill = each.getFillMatrix(mask.shape)
 
         if each.isNegativeMask() == True:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    eachp = tuple([int(x) for x in eachp])  # check int
-                    mask[eachp] = 1
+            mask[fill] = True
         else:
-            for eachp in fillPoints:
-                if eachp[0] < maxx and eachp[0] >= 0 and eachp[1] < maxy and eachp[1] >= 0:
-                    eachp = tuple([int(x) for x in eachp])  # check int
-                    mask[eachp] = 0
+            mask[fill] = False
 
     #Mask is flipped (older RAW versions had flipped image)
     mask = np.flipud(mask)
 
     return mask
 
+#Orientation of the matrices made by createMaskMatrix, part of the mask
+#digest so cached matrices are not reused if the convention changes
+mask_flip_convention = 'flipud'
+
+def getMaskObjectsDigest(img_dim, masks):
+    ''' Returns a hex digest of everything createMaskMatrix uses to make
+    the mask matrix: the image dimension, the flip convention and the type,
+    sign, points and dimension of each mask object, in order '''
+
+    description = [tuple(int(each) for each in img_dim), mask_flip_convention]
+
+    for each in masks:
+        points = [tuple(float(value) for value in point) for point in each.getPoints()]
+
+        if each._img_dimension is not None:
+            mask_dim = tuple(int(value) for value in each._img_dimension)
+        else:
+            mask_dim = None
+
+        description.append((each.getType(), bool(each.isNegativeMask()), points, mask_dim))
+
+    return hashlib.sha1(repr(description).encode('utf-8')).hexdigest()
+
+def saveMaskMatrix(filename, mask):
+    ''' Saves a mask matrix as a boolean .npy file, which loadMaskMatrix
+    memory maps. The file is written under a temporary name and then
+    renamed, so other processes never load a partly written mask '''
+
+    temp_filename = '%s.%d.tmp' %(filename, os.getpid())
+
+    with open(temp_filename, 'wb') as mask_file:
+        np.save(mask_file, np.asarray(mask) != 0)
+
+    try:
+        os.rename(temp_filename, filename)
+    except OSError:
+        #Windows won't rename over an existing file, which has the same content
+        os.remove(temp_filename)
+
+def loadMaskMatrix(filename, img_dim):
+    ''' Loads a mask matrix saved by saveMaskMatrix. The boolean matrix is
+    returned as a read only memory map of the file, so processes loading
+    the same mask share its pages instead of each holding a copy '''
+
+    mask = np.load(filename, mmap_mode = 'r')
+
+    if mask.dtype != bool or mask.shape != tuple(img_dim):
+        raise ValueError('%s is not a mask of dimension %s' %(filename, str(tuple(img_dim))))
+
+    return mask
+
+class LRUCache:
+    ''' Dictionary with at most max_size items, the least recently used
+    item is removed when a new one is added to a full cache. '''
+
+    def __init__(self, max_size = 8):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default = None):
+        if key not in self._items:
+            return default
+
+        value = self._items.pop(key)
+        self._items[key] = value
+
+        return value
+
+    def set(self, key, value):
+        self._items.pop(key, None)
+
+        while len(self._items) >= self.max_size:
+            self._items.popitem(last = False)
+
+        self._items[key] = value
+
+    def clear(self):
+        self._items.clear()
+
+class ArrayLRUCache(LRUCache):
+    ''' LRUCache keyed by arrays, which are not hashable, by their id. A
+    reference to each key array is kept while it is in the cache, so the id
+    is not reused by another array. '''
+
+    def __contains__(self, array):
+        entry = self._items.get(id(array))
+        return entry is not None and entry[0] is array
+
+    def get(self, array, default = None):
+        if array not in self:
+            return default
+
+        return LRUCache.get(self, id(array))[1]
+
+    def set(self, array, value):
+        LRUCache.set(self, id(array), (array, value))
+
+#Flat indices of the pixels of recently used masks, see getMaskIndices
+_mask_indices = ArrayLRUCache(8)
+
+def getMaskIndices(mask):
+    ''' Returns the flat indices of the pixels where mask is 1 (True). They
+    are calculated once per mask array and reused for the following frames '''
+
+    indices = _mask_indices.get(mask)
+
+    if indices is None:
+        indices = np.flatnonzero(mask == 1)
+        _mask_indices.set(mask, indices)
+
+    return indices
+
+def calcMaskedSum(img, mask):
+    ''' Sum of the image pixels where mask is 1, e.g. the transparent
+    beamstop ROI counter. Same as img[mask==1].sum() '''
+
+    return np.take(img, getMaskIndices(mask)).sum()
+
 def createMaskFromHdr(img, img_hdr, flipped = False):
 
     try:
@@ -791,6 +975,39 @@ def createMaskFromHdr(img, img_hdr, flipped = False):
 
     return masks
 
+#Mask matrices made from image headers, see createMaskMatrixFromHdr
+_hdr_mask_matrices = LRUCache(4)
+
+def createMaskMatrixFromHdr(img, img_hdr, flipped = False, user_masks = None):
+    ''' Returns the mask matrix of the header masks (createMaskFromHdr) and
+    the user masks (e.g. the BeamStopMask patches), if any. The matrix is
+    memoized by the bsmask_configuration, detector type, image shape, flip
+    flag and user masks, so it is only made once for a run of images with
+    the same header masks. The returned matrix is shared and read only. '''
+
+    if user_masks is not None:
+        user_digest = getMaskObjectsDigest(img.shape, user_masks)
+    else:
+        user_digest = None
+
+    key = (img_hdr['bsmask_configuration'], img_hdr['detectortype'], tuple(img.shape),
+           bool(flipped), user_digest)
+
+    mask = _hdr_mask_matrices.get(key)
+
+    if mask is None:
+        masks = createMaskFromHdr(img, img_hdr, flipped)
+
+        if user_masks is not None:
+            masks = masks + user_masks
+
+        mask = createMaskMatrix(img.shape, masks)
+        mask.flags.writeable = False
+
+        _hdr_mask_matrices.set(key, mask)
+
+    return mask
+
 def applyMaskToImage(in_image, mask):
     ''' multiplies the mask matrix to a 2D array (image) to reveal
     the an image where the mask has been applied. '''
@@ -867,7 +1084,81 @@ def removeZingers2(intensity_array, start_idx = 0, window_length = 10, sensitivi
 
     return intensity_array
 
+def dezingerBinValues(bin_values, dezing_sensitivity = 4.0, dezing_spread = 'Std', min_count = 30):
+    ''' Removes zingers from the pixel values of each q-bin in place. A value
+        is a zinger if it is larger than median + dezing_sensitivity * spread
+        of its bin, and is then replaced by the median. All bins are
+        processed together by sorting the values inside each bin.
+
+        bin_values :          (values, indptr) as returned by RadialGeometry.getBinValues
+        dezing_sensitivity :  Number of spreads above the median for a zinger
+        dezing_spread :       'Std' for the standard deviation of the bin,
+                              'MAD' for the scaled median absolute deviation
+        min_count :           Bins with fewer pixels are left untouched
+    '''
+
+    values, indptr = bin_values
+
+    counts = np.diff(indptr)
+    n_bins = len(counts)
+
+    if len(values) == 0:
+        return bin_values
+
+    bins = np.repeat(np.arange(n_bins), counts)
+
+    n = np.maximum(counts, 1).astype(np.float64)
+    starts = indptr[:-1]
+
+    def segmentMedian(data):
+        # Sort by value, then (stable) by bin, so each bin is sorted in place
+        order = np.argsort(data, kind = 'mergesort')
+        order = order[np.argsort(bins[order], kind = 'mergesort')]
+        sorted_data = data[order]
+
+        upper = np.minimum(starts + counts//2, len(data)-1)
+        lower = np.maximum(starts + (counts-1)//2, 0)
+
+        return (sorted_data[lower] + sorted_data[upper]) / 2.
+
+    median = segmentMedian(values)
+
+    if dezing_spread == 'Std':
+        mean = np.bincount(bins, weights = values, minlength = n_bins) / n
+        spread = np.sqrt(np.bincount(bins, weights = (values - mean[bins])**2, minlength = n_bins) / n)
+    elif dezing_spread == 'MAD':
+        spread = 1.4826 * segmentMedian(np.abs(values - median[bins]))
+    else:
+        raise ValueError('Unknown dezingering spread: ' + str(dezing_spread))
+
+    threshold = median + dezing_sensitivity * spread
+
+    zingers = np.logical_and(values > threshold[bins], counts[bins] >= min_count)
+
+    values[zingers] = median[bins[zingers]]
+
+    return bin_values
+
 def getIntensityFromQmatrix(qmatrix):
+    ''' Mean and error of the non zero pixel values in each q-bin. qmatrix is
+    either the dense (q-bin, pixel) matrix filled by ravg_ext, or the compact
+    (values, indptr) layout from RadialGeometry.getBinValues '''
+
+    if isinstance(qmatrix, tuple):
+        values, indptr = qmatrix
+
+        bins = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        nonzero = values != 0
+
+        n = np.bincount(bins[nonzero], minlength = len(indptr)-1).astype(np.float64)
+        y = values[nonzero]
+        bins = bins[nonzero]
+
+        I2 = np.bincount(bins, weights = y, minlength = len(n)) / n
+        variance = np.bincount(bins, weights = (y - I2[bins])**2, minlength = len(n)) / n
+        err = np.sqrt(variance) / np.sqrt(n)
+
+        return I2, err
 
     qmatrix = np.flipud(qmatrix)
     qmatrix = np.flipud(np.rot90(qmatrix,3))
@@ -885,233 +1176,1271 @@ def getIntensityFromQmatrix(qmatrix):
 
     return I2, err
 
-def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None, dezingering = 0, dezing_sensitivity = 4.0):
-    ''' Radial averaging. and calculation of readout noise from a readout noise mask.
-        It also returns the errorbars assuming possion distributed data
+def calcMaxRadius(img_dim, x_cin, y_cin):
+    ''' Returns the maximum distance in pixels from the center (x_cin, y_cin)
+    to the edges of an image with dimensions img_dim = (ylen, xlen) '''
 
-        in_image :     Input image
-        dim:           Image dimentions
-        x_c, y_c :     (x_c, y_c) Center coordinate in the image (Pixels)
-        q_range :      q_range specifying [low_q high_q]
+    ylen, xlen = img_dim
 
-    '''
+    maxlen1 = int(max(xlen - x_cin, ylen - y_cin, xlen - (xlen - x_cin), ylen - (ylen - y_cin)))
 
-    in_image = np.float64(in_image)
+    diag1 = int(np.sqrt((xlen-x_cin)**2 + y_cin**2))
+    diag2 = int(np.sqrt((x_cin**2 + y_cin**2)))
+    diag3 = int(np.sqrt((x_cin**2 + (ylen-y_cin)**2)))
+    diag4 = int(np.sqrt((xlen-x_cin)**2 + (ylen-y_cin)**2))
 
-    ylen, xlen = in_image.shape
+    maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
 
-    xlen = np.int(xlen)
-    ylen = np.int(ylen)
+    return maxlen
 
-    # If no mask is given, the mask is pure ones
-    if mask is None:
-        mask = np.ones(in_image.shape)
+#Thread pools used by RadialGeometry.integrate, by number of threads, and
+#the process they were started in (threads do not survive a fork)
+_thread_pools = {}
+_thread_pools_pid = None
 
-    if readoutNoise_mask is None:
-        readoutNoiseFound = 0
-        readoutNoise_mask = np.zeros(in_image.shape, dtype = np.float64)
-    else:
-        readoutNoiseFound = 1
+def getThreadPool(workers):
+    ''' Returns a ThreadPool with workers threads. The pool is started on
+    the first call and reused afterwards, instead of starting threads for
+    every frame. '''
 
-    readoutN = np.zeros((1,4), dtype = np.float64)
+    global _thread_pools_pid
 
-    # Find the maximum distance to the edge in the image:
-    maxlen1 = int(max(xlen - x_cin, ylen - y_cin, xlen - (xlen - x_cin), ylen - (ylen - y_cin)))
+    if _thread_pools_pid != os.getpid():
+        _thread_pools.clear()
+        _thread_pools_pid = os.getpid()
 
-    diag1 = int(np.sqrt((xlen-x_cin)**2 + y_cin**2))
-    diag2 = int(np.sqrt((x_cin**2 + y_cin**2)))
-    diag3 = int(np.sqrt((x_cin**2 + (ylen-y_cin)**2)))
-    diag4 = int(np.sqrt((xlen-x_cin)**2 + (ylen-y_cin)**2))
+    if workers not in _thread_pools:
+        _thread_pools[workers] = multiprocessing.pool.ThreadPool(workers)
 
-    maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+    return _thread_pools[workers]
 
-    #print(diag1, diag2, diag3, diag4, maxlen1)
+class RadialGeometry:
+    ''' Pixel to q-bin lookup table for the radial average of images with
+    a given shape, center and masks.
 
-    # we set the "q_limits" (in pixels) so that it does radial avg on entire image (maximum qrange possible).
-    q_range = (0, maxlen)
+    The flat indices of the accepted pixels are stored grouped by q-bin
+    (CSR layout, bin i is indices[indptr[i]:indptr[i+1]]), so every bin is
+    summed straight from the image in its own dtype. Build it once and
+    reuse it for all frames with the same geometry (see GeometryCache).
+    '''
 
-    ##############################################
-    # Reserving memory for radial averaged output:
-    ##############################################
-    hist = np.zeros(q_range[1], dtype = np.float64)
-    hist_count = np.zeros((3,q_range[1]), dtype = np.float64)  # -----" --------- for number of pixels in a circle at a certain q
+    # Approximate number of pixels in each band of rows integrated at once
+    band_pixels = 2**20
 
-    qmatrix = np.zeros((q_range[1], 4*xlen), dtype = np.float64)
+    # Number of bins sorted together by integrateRobust, neighbouring bins
+    # have about the same number of pixels so little padding is needed
+    bin_rows_group = 16
 
-    low_q = q_range[0]
-    high_q = q_range[1]
+    def __init__(self, img_dim, x_cin, y_cin, mask = None, readoutNoise_mask = None, q_range = None,
+                 radius_edges = None, active_range = None):
+        ''' img_dim, x_cin, y_cin, mask and readoutNoise_mask as for
+        radialAverage. q_range = (low_q, high_q) in pixels, defaults to
+        the entire image.
 
-    # This code is faulty.. x has been switched with y
-    x_c = float(y_cin)
-    y_c = float(x_cin)
+        active_range = (first_bin, last_bin) limits the pixels that are
+        integrated to the bins first_bin <= bin < last_bin (see
+        calcActiveRange), the other bins are left empty. The readout noise
+        pixels are not limited.
 
-    xlen_1 = ylen
-    ylen_1 = xlen
+        radius_edges are increasing bin edges in pixels (e.g. q-bin edges
+        converted with SASCalib.calcPixelsFromQ). If given, pixels are
+        binned by their exact distance from the center into these bins
+        instead of the integer pixel radius, and q_range is not used. '''
 
-    # print(np.any(hist<0))
-    # print(np.any(hist<0))
+        ylen, xlen = img_dim
 
-    print('Radial averaging in progress...',)
+        if q_range is None:
+            q_range = (0, calcMaxRadius(img_dim, x_cin, y_cin))
 
-    if RAWGlobals.compiled_extensions:
-        ravg_ext.ravg(readoutNoiseFound,
-                       readoutN,
-                       readoutNoise_mask,
-                       xlen_1, ylen_1,
-                       x_c, y_c,
-                       hist,
-                       low_q, high_q,
-                       in_image,
-                       hist_count, mask, qmatrix, dezingering, dezing_sensitivity)
-    else:
-        ravg_python(readoutNoiseFound,
-                       readoutN,
-                       readoutNoise_mask,
-                       xlen_1, ylen_1,
-                       x_c, y_c,
-                       hist,
-                       low_q, high_q,
-                       in_image,
-                       hist_count, mask, qmatrix, dezingering, dezing_sensitivity)
+        self.img_dim = (int(ylen), int(xlen))
+        self.center = (float(x_cin), float(y_cin))
+        self.q_range = (int(q_range[0]), int(q_range[1]))
 
-    print('done')
+        low_q, high_q = self.q_range
 
-    # print(np.any(hist<0))
-    # print(np.any(hist_count<0))
+        # x is the row and y the column here, as in radialAverage
+        rel_x = np.arange(ylen, dtype = np.float64) - float(y_cin)
+        rel_y = float(x_cin) - np.arange(xlen, dtype = np.float64)
 
-    hist_cnt = hist_count[2,:]    #contains x-mean
+        radius = np.sqrt(rel_y[np.newaxis, :]**2. + rel_x[:, np.newaxis]**2.).ravel()
 
-    hist_count = hist_count[0,:]  #contains N
+        if radius_edges is None:
+            self.radius_edges = None
 
-    std_i = np.sqrt(hist_cnt/hist_count)
+            r = radius.astype(np.intp)
+            n_bins = high_q
 
-    std_i[np.where(np.isnan(std_i))] = 0
+            in_qrange = np.logical_and(r > low_q, r < high_q)
+            noise_range = np.logical_and(r > low_q, r < high_q-1)
+        else:
+            self.radius_edges = np.array(radius_edges, dtype = np.float64)
 
-    iq = hist / hist_count
+            r = np.searchsorted(self.radius_edges, radius, side = 'right') - 1
+            n_bins = len(self.radius_edges) - 1
 
-    # print(iq)
+            in_qrange = np.logical_and(r >= 0, r < n_bins)
+            noise_range = in_qrange
 
-    if x_c > 0 and x_c < xlen and y_c > 0 and y_c < ylen:
-        iq[0] = in_image[int(round(x_c)), int(round(y_c))]  #the center is not included in the radial average, so it is set manually her
+        self.active_range = active_range
 
+        if active_range is not None:
+            in_qrange = np.logical_and(in_qrange, np.logical_and(r >= active_range[0], r < active_range[1]))
 
-    #Estimated Standard deviation   - equal to the std of pixels in the area / sqrt(N)
-    errorbars = std_i / np.sqrt(hist_count)
+        if mask is not None:
+            pixels = np.flatnonzero(np.logical_and(in_qrange, mask.ravel() == 1))
+        else:
+            pixels = np.flatnonzero(in_qrange)
 
+        bins = r[pixels]
 
-    if readoutNoiseFound:
-        #Average readoutNoise
-        readoutNoise = readoutN[0,1] /  readoutN[0,0]   ## sum(img(x,y)) / N
-        print('Readout Noise: ', readoutNoise)
+        # Group the pixels by bin, keeping the image order inside each bin
+        # (a stable sort of small unsigned ints is a radix sort in numpy)
+        if n_bins <= np.iinfo(np.uint16).max:
+            order = np.argsort(bins.astype(np.uint16), kind = 'mergesort')
+        else:
+            order = np.argsort(bins, kind = 'mergesort')
 
-        #Estimated Standard deviation   - equal to the std of pixels in the area / sqrt(N)
-        std_n = np.sqrt(readoutN[0,3] / readoutN[0,0])    # sqrt((X-MEAN)/N)
-        errorbarNoise = std_n / np.sqrt(readoutN[0,0])
+        self.indices = pixels[order]
+        self.bins = bins[order]
+        self.counts = np.bincount(self.bins, minlength = n_bins)
 
-        print('Readout Noise Err: ', errorbarNoise)
+        self.indptr = np.zeros(n_bins + 1, dtype = np.intp)
+        np.cumsum(self.counts, out = self.indptr[1:])
 
-        #Readoutnoise average subtraction
-        iq = iq - readoutNoise
-        errorbars = np.sqrt(np.power(errorbars, 2) + np.power(errorbarNoise, 2))
+        # Mean distance of the pixels of each bin from the center, the
+        # position of the bins when they are not whole pixels
+        if self.radius_edges is not None:
+            radius_sum = np.bincount(self.bins, weights = radius[self.indices], minlength = n_bins)
 
+            self.bin_radius = np.full(n_bins, np.nan)
+            np.divide(radius_sum, self.counts, out = self.bin_radius, where = self.counts > 0)
+        else:
+            self.bin_radius = None
 
-    iq[np.where(np.isnan(iq))] = 0
-    errorbars[np.where(np.isnan(errorbars))] = 1e-10
+        if readoutNoise_mask is not None:
+            self.readout_indices = np.flatnonzero(np.logical_and(noise_range, readoutNoise_mask.ravel() == 0))
+        else:
+            self.readout_indices = None
+
+        self._bin_map = None
+        self._bands = None
+        self._bin_rows = None
+        self._chi = None
+        self._matrix = None
+
+        # Integration backend picked by selectIntegrationBackend, and the
+        # number of times it was asked to pick one
+        self.backend = None
+        self.backend_timings = {}
+        self.backend_requests = 0
+
+    def integrate(self, in_image, workers = 1, dtype = np.float64):
+        ''' Returns hist, hist_count and readoutN for in_image, with the same
+        contents as filled in by ravg_python (without dezingering):
+
+        hist :        Sum of the pixel values in each bin
+        hist_count :  N, mean and M2 (sum of squared deviations) of each bin
+        readoutN :    N, sum, mean and M2 of the readout noise pixels
+
+        Large images are integrated in bands of rows (see band_pixels), which
+        are merged in order, so the result does not depend on the number of
+        worker threads.
+
+        The pixels are read in the dtype of the image and summed in dtype
+        (np.float64, or np.float32 for speed), without converting the image.
+        '''
 
-    q = np.linspace(0, len(iq)-1, len(iq))
+        if in_image.shape != self.img_dim:
+            raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
 
-    if dezingering == 1:
-        iq, errorbars = getIntensityFromQmatrix(qmatrix)
-        iq[np.where(np.isnan(iq))] = 0
-        errorbars[np.where(np.isnan(errorbars))] = 1e-10
+        flat_img = np.ravel(in_image)
 
-    #Trim trailing zeros
-    # iq = np.trim_zeros(iq, 'b')
-    iq = iq[:-5]        #Last points are usually garbage they're very few pixels
-                        #Cutting the last 5 points here.
-    q = q[0:len(iq)]
-    errorbars = errorbars[0:len(iq)]
+        bands = self._getBands()
 
-    return [iq, q, errorbars, qmatrix]
+        if workers > 1 and len(bands) > 1:
+            pool = getThreadPool(min(workers, len(bands)))
+            partials = pool.map(lambda band: self._integrateBand(flat_img, band, dtype), bands)
+        else:
+            partials = [self._integrateBand(flat_img, band, dtype) for band in bands]
 
+        # Merge the bands in order with the parallel variance algorithm
+        hist, n, mean, m2 = partials[0]
 
-def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings, mask = None, tbs_mask = None):
-    print('using pyfai!!!!')
-    # Get appropriate settings
-    sd_distance = raw_settings.get('SampleDistance')
-    pixel_size = raw_settings.get('DetectorPixelSize')
-    wavelength = raw_settings.get('WaveLength')
-    bin_size = raw_settings.get('Binsize')
-    normlist = raw_settings.get('NormalizationList')
+        for band_hist, band_n, band_mean, band_m2 in partials[1:]:
+            total_n = n + band_n
+            delta = band_mean - mean
 
-    do_calibration = raw_settings.get('CalibrateMan')
-    do_normalization = raw_settings.get('EnableNormalization')
-    do_flatfield = raw_settings.get('NormFlatfieldEnabled')
-    do_solidangle = raw_settings.get('DoSolidAngleCorrection')
-    do_useheaderforcalib = raw_settings.get('UseHeaderForCalib')
+            weight = np.zeros_like(total_n)
+            np.divide(band_n, total_n, out = weight, where = total_n > 0)
 
-    #Put everything in appropriate units
-    pixel_size = pixel_size *1e-6 #convert pixel size to m
-    wavelength = wavelength*1e-10 #convert wl to m
+            m2 = m2 + band_m2 + delta**2 * n * weight
+            mean = mean + delta * weight
+            hist = hist + band_hist
+            n = total_n
 
-    if do_useheaderforcalib:
-        img_hdr = parameters['imageHeader']
-        file_hdr = parameters['counters']
+        if len(partials) > 1:
+            mean = np.zeros_like(hist)
+            np.divide(hist, n, out = mean, where = n > 0)
 
-        result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
-        if result[0] is not None: sd_distance = result[0]
-        if result[1] is not None: pixel_size = result[1]
-        if result[2] is not None: wavelength = result[2]
+        hist_count = np.vstack((n, mean, m2))
 
-    #Set up mask
-    img = np.float64(img)
+        readoutN = self.getReadoutNoise(flat_img)
 
-    ylen, xlen = img.shape
+        return hist, hist_count, readoutN
 
-    xlen = int(xlen)
-    ylen = int(ylen)
+    def getReadoutNoise(self, flat_img):
+        ''' Returns readoutN, the N, sum, mean and M2 of the readout noise
+        pixels of the flattened image, as a (1, 4) array. '''
 
-    # If no mask is given, the mask is pure zeroes
-    if mask is None:
-        mask = np.zeroes(img.shape)
+        readoutN = np.zeros((1,4), dtype = np.float64)
 
-    else:
-        mask = np.logical_not(mask)
+        if self.readout_indices is not None and len(self.readout_indices) > 0:
+            noise_values = flat_img.take(self.readout_indices).astype(np.float64)
+            noise_mean = noise_values.mean()
 
-    # if readoutNoise_mask is None:
-    #     readoutNoiseFound = 0
-    #     readoutNoise_mask = np.zeros(img.shape, dtype = np.float64)
-    # else:
-    #     readoutNoiseFound = 1
+            readoutN[0,0] = len(noise_values)
+            readoutN[0,1] = noise_values.sum()
+            readoutN[0,2] = noise_mean
+            readoutN[0,3] = ((noise_values - noise_mean)**2).sum()
 
-    # readoutN = np.zeros((1,4), dtype = np.float64)
+        return readoutN
 
-    # Find the maximum distance to the edge in the image:
-    maxlen1 = int(max(xlen - x_cin, ylen - y_cin, xlen - (xlen - x_cin), ylen - (ylen - y_cin)))
+    def getSparseMatrix(self):
+        ''' Returns the accepted pixels as a sparse CSR matrix with one row
+        per q-bin, so the bin sums are a mat-vec with the flattened image.
+        Built on the first call. '''
 
-    diag1 = int(np.sqrt((xlen-x_cin)**2 + y_cin**2))
-    diag2 = int(np.sqrt((x_cin**2 + y_cin**2)))
-    diag3 = int(np.sqrt((x_cin**2 + (ylen-y_cin)**2)))
-    diag4 = int(np.sqrt((xlen-x_cin)**2 + (ylen-y_cin)**2))
+        if self._matrix is None:
+            self._matrix = scipy.sparse.csr_matrix((np.ones(len(self.indices)), self.indices, self.indptr),
+                                                   shape = (len(self.counts), self.img_dim[0]*self.img_dim[1]))
 
-    maxlen = int(max(diag1, diag2, diag3, diag4, maxlen1))
+        return self._matrix
 
-    x_c = float(x_cin)
-    y_c = float(y_cin)
+    def getMasks(self):
+        ''' Returns float64 mask and readout noise mask arrays that select the
+        same pixels as the geometry, in the form used by ravg_ext. '''
 
-    ai = pyFAI.AzimuthalIntegrator()
+        mask = np.zeros(self.img_dim, dtype = np.float64)
+        mask.flat[self.indices] = 1
 
-    if do_calibration:
-        ai.wavelength = wavelength
-        ai.pixel1 = pixel_size
-        ai.pixel2 = pixel_size
-        ai.setFit2D(sd_distance, x_c, y_c)
+        readoutNoise_mask = np.ones(self.img_dim, dtype = np.float64)
+        if self.readout_indices is not None:
+            readoutNoise_mask.flat[self.readout_indices] = 0
 
-    if do_flatfield:
-        flatfield_filename = raw_settings.get('NormFlatfieldFile')
-        ai.set_flatfiles(flatfield_filename)
+        return mask, readoutNoise_mask
+
+    def _getBands(self):
+        ''' Splits the accepted pixels into bands of whole rows with about
+        band_pixels pixels each. Every band is (first pixel, last pixel + 1,
+        pixel indices inside the band, bins, counts, indptr). Built on the
+        first call. '''
+
+        if self._bands is not None:
+            return self._bands
+
+        ylen, xlen = self.img_dim
+        n_bins = len(self.counts)
+
+        band_rows = max(1, self.band_pixels // xlen)
+
+        if band_rows >= ylen:
+            self._bands = [(0, ylen*xlen, self.indices, self.bins, self.counts, self.indptr)]
+            return self._bands
+
+        self._bands = []
+
+        band_ids = (self.indices // (band_rows*xlen)).astype(np.uint16)
+
+        # Stable, so the pixels stay sorted by bin inside each band
+        order = np.argsort(band_ids, kind = 'mergesort')
+        band_edges = np.searchsorted(band_ids[order], np.arange(0, ylen, band_rows) // band_rows)
+        band_edges = np.append(band_edges, len(order))
+
+        for band_idx, first_row in enumerate(range(0, ylen, band_rows)):
+            start = first_row*xlen
+            stop = min(first_row + band_rows, ylen)*xlen
+
+            band_order = order[band_edges[band_idx]:band_edges[band_idx+1]]
+
+            indices = self.indices[band_order] - start
+            bins = self.bins[band_order]
+            counts = np.bincount(bins, minlength = n_bins)
+
+            indptr = np.zeros(n_bins + 1, dtype = np.intp)
+            np.cumsum(counts, out = indptr[1:])
+
+            self._bands.append((start, stop, indices, bins, counts, indptr))
+
+        return self._bands
+
+    def _integrateBand(self, flat_img, band, dtype = np.float64):
+        ''' Sum, N, mean and M2 of each bin for the pixels of one band '''
+
+        start, stop, indices, bins, counts, indptr = band
+
+        n_bins = len(counts)
+        filled = counts > 0
+        starts = indptr[:-1][filled]
+
+        values = flat_img[start:stop].take(indices)
+
+        hist = np.zeros(n_bins, dtype = np.float64)
+        m2 = np.zeros(n_bins, dtype = np.float64)
+
+        n = counts.astype(np.float64)
+        mean = np.zeros(n_bins, dtype = np.float64)
+
+        if len(values) > 0:
+            hist[filled] = np.add.reduceat(values, starts, dtype = dtype)
+            np.divide(hist, n, out = mean, where = filled)
+
+            deviation = np.subtract(values, mean.astype(dtype).take(bins), dtype = dtype)
+            np.square(deviation, out = deviation)
+
+            m2[filled] = np.add.reduceat(deviation, starts, dtype = dtype)
+
+        return hist, n, mean, m2
+
+    def getBinValues(self, in_image):
+        ''' Returns the accepted pixel values grouped by q-bin, in image order
+        inside each bin, as (values, indptr): the values of bin i are
+        values[indptr[i]:indptr[i+1]]. This is a compact replacement for
+        the dense qmatrix used when dezingering. '''
+
+        values = np.ravel(in_image).take(self.indices).astype(np.float64)
+
+        return values, self.indptr
+
+    def getChi(self):
+        ''' Returns the azimuthal angle (degrees, -180 to 180) of the accepted
+        pixels, in the order of self.indices, counterclockwise from the x
+        axis of the image as displayed in RAW. Built on the first call. '''
+
+        if self._chi is None:
+            rows, cols = np.divmod(self.indices, self.img_dim[1])
+
+            chi = np.degrees(np.arctan2(rows - self.center[1], cols - self.center[0]))
+            chi[chi >= 180.] -= 360.
+
+            self._chi = chi
+
+        return self._chi
+
+    def getBinRows(self):
+        ''' Returns the bin membership index used by integrateRobust, a list
+        of (first_bin, last_bin, rows) for groups of bin_rows_group
+        consecutive bins. rows[i] holds the positions in self.indices of
+        the pixels of bin first_bin + i, padded with len(self.indices) to
+        the largest bin of the group, so a group of bins is sorted with one
+        np.sort(..., axis = 1). Built on the first call. '''
+
+        if self._bin_rows is None:
+            self._bin_rows = []
+
+            for first_bin in range(0, len(self.counts), self.bin_rows_group):
+                last_bin = min(first_bin + self.bin_rows_group, len(self.counts))
+                counts = self.counts[first_bin:last_bin]
+
+                if counts.max() == 0:
+                    continue
+
+                cols = np.arange(counts.max())
+                rows = np.where(cols < counts[:, np.newaxis], self.indptr[first_bin:last_bin, np.newaxis] + cols,
+                                len(self.indices))
+
+                self._bin_rows.append((first_bin, last_bin, rows))
+
+        return self._bin_rows
+
+    def getBinMap(self):
+        ''' Returns the q-bin of every pixel of the flattened image, with
+        len(self.counts) for the pixels that are not used. Built on the
+        first call. '''
+
+        if self._bin_map is None:
+            self._bin_map = np.full(self.img_dim[0]*self.img_dim[1], len(self.counts), dtype = np.intp)
+            self._bin_map[self.indices] = self.bins
+
+        return self._bin_map
+
+class GeometryCache:
+    ''' Keeps RadialGeometry objects (and pyFAI integrators) so they can be
+    reused for every frame with the same image shape, center, masks and q
+    limits. The masks are identified by a digest of their contents, which
+    is only calculated once per mask array. '''
+
+    def __init__(self, max_size = 8):
+        self._geometries = LRUCache(max_size)
+        self._integrators = LRUCache(max_size)
+
+        # Room for the mask and readout noise mask of every geometry, and
+        # the mask of every integrator
+        self._digests = ArrayLRUCache(3*max_size)
+
+    def clear(self):
+        self._geometries.clear()
+        self._integrators.clear()
+        self._digests.clear()
+
+    def getMaskDigest(self, mask):
+        if mask is None:
+            return None
+
+        digest = self._digests.get(mask)
+
+        if digest is None:
+            contiguous = np.ascontiguousarray(mask)
+            md5 = hashlib.md5(str((contiguous.shape, contiguous.dtype.str)).encode('utf-8'))
+            md5.update(contiguous.view(np.uint8))
+            digest = md5.hexdigest()
+
+            self._digests.set(mask, digest)
+
+        return digest
+
+    def getGeometry(self, img_dim, x_cin, y_cin, mask = None, readoutNoise_mask = None, q_range = None,
+                    radius_edges = None, active_range = None):
+        ''' Returns the RadialGeometry for the arguments (see RadialGeometry),
+        building it if it is not in the cache. '''
+
+        if q_range is None:
+            q_range = (0, calcMaxRadius(img_dim, x_cin, y_cin))
+
+        if radius_edges is not None:
+            edges_key = np.asarray(radius_edges, dtype = np.float64).tobytes()
+        else:
+            edges_key = None
+
+        key = (tuple(img_dim), float(x_cin), float(y_cin), self.getMaskDigest(mask),
+               self.getMaskDigest(readoutNoise_mask), tuple(q_range), edges_key,
+               None if active_range is None else tuple(active_range))
+
+        geometry = self._geometries.get(key)
+
+        if geometry is None:
+            geometry = RadialGeometry(img_dim, x_cin, y_cin, mask, readoutNoise_mask, q_range, radius_edges,
+                                      active_range)
+
+            self._geometries.set(key, geometry)
+
+        return geometry
+
+    def getAzimuthalIntegrator(self, img_dim, x_c, y_c, mask = None, calibration = None, flatfield_filename = None):
+        ''' Returns the pyFAI AzimuthalIntegrator for the arguments (see
+        createAzimuthalIntegrator), creating it if it is not in the cache.
+        pyFAI keeps its integration engines (e.g. the CSR matrix) on the
+        integrator, so they are also reused. '''
+
+        if flatfield_filename is not None and os.path.exists(flatfield_filename):
+            flatfield_key = (flatfield_filename, os.path.getmtime(flatfield_filename))
+        else:
+            flatfield_key = flatfield_filename
+
+        key = (tuple(img_dim), float(x_c), float(y_c), self.getMaskDigest(mask),
+               None if calibration is None else tuple(calibration), flatfield_key)
+
+        ai = self._integrators.get(key)
+
+        if ai is None:
+            ai = createAzimuthalIntegrator(img_dim, x_c, y_c, mask, calibration, flatfield_filename)
+
+            self._integrators.set(key, ai)
+
+        return ai
+
+def integrateNumpy(in_image, geometry, workers = 1, dtype = np.float64):
+    ''' Integration backend using the bin grouped pixel indices of the geometry '''
+
+    return geometry.integrate(in_image, workers, dtype)
+
+def integrateSparse(in_image, geometry, workers = 1, dtype = np.float64):
+    ''' Integration backend using sparse mat-vecs with the bin matrix of the geometry '''
+
+    if in_image.shape != geometry.img_dim:
+        raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+    flat_img = np.ravel(in_image)
+    matrix = geometry.getSparseMatrix()
+
+    hist = matrix.dot(flat_img)
+
+    n = geometry.counts.astype(np.float64)
+    filled = geometry.counts > 0
+
+    mean = np.zeros(len(n), dtype = np.float64)
+    np.divide(hist, n, out = mean, where = filled)
+
+    # The deviations are only needed for the accepted pixels, which are
+    # grouped by bin as in RadialGeometry._integrateBand
+    m2 = np.zeros(len(n), dtype = np.float64)
+
+    if len(geometry.indices) > 0:
+        deviation = np.subtract(flat_img.take(geometry.indices), mean.astype(dtype).take(geometry.bins), dtype = dtype)
+        np.square(deviation, out = deviation)
+
+        m2[filled] = np.add.reduceat(deviation, geometry.indptr[:-1][filled], dtype = dtype)
+
+    hist_count = np.vstack((n, mean, m2))
+
+    return hist, hist_count, geometry.getReadoutNoise(flat_img)
+
+# Largest fraction of non-zero pixels for which integrateNonzero only
+# visits the non-zero pixels, denser frames use RadialGeometry.integrate
+nonzero_max_fill = 0.1
+
+def integrateNonzero(in_image, geometry, workers = 1, dtype = np.float64):
+    ''' Integration backend for sparse frames, e.g. short exposures on photon
+    counting detectors. Only the non-zero pixels are summed into their bins,
+    the zero pixels are accounted for with the pixel counts of the bins.
+    Frames with more than nonzero_max_fill non-zero pixels are integrated
+    with RadialGeometry.integrate. The deviations are calculated in dtype,
+    np.bincount sums them in float64. '''
+
+    if in_image.shape != geometry.img_dim:
+        raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+    flat_img = np.ravel(in_image)
+
+    # nonzero is much faster on a boolean array than on the image itself
+    is_nonzero = flat_img != 0
+
+    if np.count_nonzero(is_nonzero) > nonzero_max_fill * len(flat_img):
+        return geometry.integrate(in_image, workers, dtype)
+
+    nonzero = np.flatnonzero(is_nonzero)
+
+    n_bins = len(geometry.counts)
+
+    # Unused pixels go to the extra last bin
+    bins = geometry.getBinMap().take(nonzero)
+    values = flat_img.take(nonzero).astype(dtype)
+
+    hist = np.bincount(bins, weights = values, minlength = n_bins+1)[:-1]
+
+    n = geometry.counts.astype(np.float64)
+    n_nonzero = np.bincount(bins, minlength = n_bins+1)[:-1]
+
+    mean = np.zeros(n_bins+1, dtype = np.float64)
+    np.divide(hist, n, out = mean[:-1], where = geometry.counts > 0)
+
+    deviation = np.subtract(values, mean.astype(dtype).take(bins), dtype = dtype)
+    np.square(deviation, out = deviation)
+
+    # Every zero pixel deviates by -mean from the mean of its bin
+    m2 = np.bincount(bins, weights = deviation, minlength = n_bins+1)[:-1]
+    m2 += (n - n_nonzero) * mean[:-1]**2
+
+    hist_count = np.vstack((n, mean[:-1], m2))
+
+    return hist, hist_count, geometry.getReadoutNoise(flat_img)
+
+def integrateRobust(in_image, geometry, mode = 'Median', clip_sigma = 3.0, clip_iterations = 5):
+    ''' Outlier resistant integration, returns hist, hist_count and readoutN
+    as RadialGeometry.integrate, with the mean of each bin replaced by
+
+    'Median' :     the median of the bin pixels. The spread is the
+                   interquartile range / 1.349 (the std if that is 0),
+                   times sqrt(pi/2) for the error of a median.
+    'SigmaClip' :  the mean of the bin pixels within clip_sigma std of the
+                   mean, iterated up to clip_iterations times or until no
+                   more pixels are clipped. N and M2 are those of the
+                   pixels that are kept.
+
+    The pixels of groups of bins are sorted together with the bin
+    membership index of the geometry (see RadialGeometry.getBinRows). The
+    pixels kept by sigma clipping are then a contiguous range of each
+    sorted bin, so every iteration only needs prefix sums.
+    '''
+
+    if in_image.shape != geometry.img_dim:
+        raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+    if mode not in ('Median', 'SigmaClip'):
+        raise ValueError('Unknown integration mode: ' + str(mode))
+
+    flat_img = np.ravel(in_image)
+
+    # The padding of the bin rows points at the inf at the end, so it is
+    # sorted after the pixels of every bin
+    values = np.empty(len(geometry.indices)+1, dtype = np.float64)
+    values[:-1] = flat_img.take(geometry.indices)
+    values[-1] = np.inf
+
+    n_bins = len(geometry.counts)
+
+    hist = np.zeros(n_bins, dtype = np.float64)
+    hist_count = np.zeros((3, n_bins), dtype = np.float64)
+
+    for first_bin, last_bin, rows in geometry.getBinRows():
+        counts = geometry.counts[first_bin:last_bin]
+        filled = counts > 0
+        idx = np.arange(len(counts))
+
+        sorted_values = np.sort(values.take(rows), axis = 1)
+
+        lower = np.maximum((counts-1)//2, 0)
+        median = (sorted_values[idx, lower] + sorted_values[idx, counts//2]) / 2.
+        median[~filled] = 0
+
+        # Deviations from the median, with the padding set to 0 for the sums
+        deviation = sorted_values - median[:, np.newaxis]
+        summed = np.where(np.arange(rows.shape[1]) < counts[:, np.newaxis], deviation, 0)
+
+        n = counts.astype(np.float64)
+
+        if mode == 'Median':
+            q1 = sorted_values[idx, ((counts-1)*0.25).astype(np.intp)]
+            q3 = sorted_values[idx, np.maximum(((counts-1)*0.75).astype(np.intp), 0)]
+
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                spread = (q3 - q1) / 1.349
+                std = np.sqrt(np.sum(summed**2, axis = 1)/n - (np.sum(summed, axis = 1)/n)**2)
+
+            spread = np.where(spread > 0, spread, std) * np.sqrt(np.pi/2.)
+            center = median
+
+        else:
+            cum_sum = np.zeros((len(counts), rows.shape[1]+1), dtype = np.float64)
+            cum_sq = np.zeros_like(cum_sum)
+            np.cumsum(summed, axis = 1, out = cum_sum[:, 1:])
+            np.cumsum(summed**2, axis = 1, out = cum_sq[:, 1:])
+
+            low_idx = np.zeros(len(counts), dtype = np.intp)
+            high_idx = counts.astype(np.intp)
+
+            for iteration in range(max(clip_iterations, 0) + 1):
+                n = (high_idx - low_idx).astype(np.float64)
+
+                with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                    mean = (cum_sum[idx, high_idx] - cum_sum[idx, low_idx]) / n
+                    variance = (cum_sq[idx, high_idx] - cum_sq[idx, low_idx]) / n - mean**2
+
+                spread = np.sqrt(np.maximum(variance, 0))
+
+                if iteration == clip_iterations:
+                    break
+
+                # Sorted rows, so the kept pixels are the ones between
+                new_low = np.sum(deviation < (mean - clip_sigma*spread)[:, np.newaxis], axis = 1)
+                new_high = np.sum(deviation <= (mean + clip_sigma*spread)[:, np.newaxis], axis = 1)
+
+                new_low[~filled] = 0
+                new_high[~filled] = 0
+
+                if np.array_equal(new_low, low_idx) and np.array_equal(new_high, high_idx):
+                    break
+
+                low_idx, high_idx = new_low, new_high
+
+            center = median + mean
+
+        center[n == 0] = 0
+
+        hist[first_bin:last_bin] = np.where(n > 0, center * n, 0)
+        hist_count[0, first_bin:last_bin] = n
+        hist_count[1, first_bin:last_bin] = center
+        hist_count[2, first_bin:last_bin] = np.where(n > 0, spread**2 * n, 0)
+
+    return hist, hist_count, geometry.getReadoutNoise(flat_img)
+
+def integrateRavg(ravg, in_image, geometry):
+    ''' Integrates with the pixel loop of ravg_ext.ravg or ravg_python,
+    using masks rebuilt from the geometry. '''
+
+    if in_image.shape != geometry.img_dim:
+        raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+    if geometry.radius_edges is not None:
+        raise ValueError('The ravg backends only integrate whole pixel bins.')
+
+    ylen, xlen = geometry.img_dim
+    x_cin, y_cin = geometry.center
+    low_q, high_q = geometry.q_range
+
+    mask, readoutNoise_mask = geometry.getMasks()
+
+    readoutNoiseFound = int(geometry.readout_indices is not None)
+
+    hist = np.zeros(high_q, dtype = np.float64)
+    hist_count = np.zeros((3, high_q), dtype = np.float64)
+    readoutN = np.zeros((1,4), dtype = np.float64)
+
+    # qmatrix is only written when dezingering, which is not done here
+    qmatrix = np.zeros((1, 1), dtype = np.float64)
+
+    # This code is faulty.. x has been switched with y
+    ravg(readoutNoiseFound, readoutN, readoutNoise_mask, ylen, xlen, float(y_cin), float(x_cin),
+         hist, low_q, high_q, np.float64(in_image), hist_count, mask, qmatrix, 0, 4.0)
+
+    return hist, hist_count, readoutN
+
+def integrateCompiled(in_image, geometry, workers = 1, dtype = np.float64):
+    ''' Integration backend using the compiled ravg_ext module '''
+
+    return integrateRavg(ravg_ext.ravg, in_image, geometry)
+
+def integratePython(in_image, geometry, workers = 1, dtype = np.float64):
+    ''' Integration backend using the pure python pixel loop (slow) '''
+
+    return integrateRavg(ravg_python, in_image, geometry)
+
+# 1D integration backends. Each is a function(in_image, geometry, workers, dtype)
+# returning hist, hist_count and readoutN as RadialGeometry.integrate
+integration_backends = collections.OrderedDict()
+
+# Backends that selectIntegrationBackend benchmarks
+auto_integration_backends = []
+
+def registerIntegrationBackend(name, function, auto = True):
+    ''' Adds a 1D integration backend. If auto is True, it is a candidate
+    for the automatic backend selection. '''
+
+    integration_backends[name] = function
+
+    if auto and name not in auto_integration_backends:
+        auto_integration_backends.append(name)
+
+registerIntegrationBackend('numpy', integrateNumpy)
+registerIntegrationBackend('sparse', integrateSparse)
+registerIntegrationBackend('nonzero', integrateNonzero)
+if RAWGlobals.compiled_extensions:
+    registerIntegrationBackend('compiled', integrateCompiled)
+registerIntegrationBackend('python', integratePython, auto = False)
+
+def selectIntegrationBackend(in_image, geometry, workers = 1, dtype = np.float64, repeats = 3):
+    ''' Returns the fastest of the automatic integration backends for the
+    geometry. The backends are timed on in_image (after a warm up call,
+    which builds the lookup tables) with the best of repeats runs, later
+    calls return the choice stored on the geometry.
+
+    Timing only pays off if the geometry is reused, so the first call
+    returns 'numpy' and the backends are timed on the second call. A
+    geometry that is made for a single frame is never timed. '''
+
+    if geometry.backend is None:
+        geometry.backend_requests += 1
+
+        if geometry.backend_requests < 2:
+            return 'numpy'
+
+        timings = {}
+
+        for name in auto_integration_backends:
+            integration_backends[name](in_image, geometry, workers, dtype)
+
+            best = None
+            for i in range(repeats):
+                start = time.perf_counter()
+                integration_backends[name](in_image, geometry, workers, dtype)
+                elapsed = time.perf_counter() - start
+
+                if best is None or elapsed < best:
+                    best = elapsed
+
+            timings[name] = best
+
+        geometry.backend_timings = timings
+        geometry.backend = min(timings, key = timings.get)
+
+    return geometry.backend
+
+def calcActiveRange(n_bins, bin_size = 1, start_point = 0, end_point = 0, trim = 5):
+    ''' Returns the (first_bin, last_bin) pixel bins of a radial average
+        with n_bins bins that end up in the selected q range of the
+        measurement, (start_point, n - end_point) after the last trim points
+        are cut and the profile is rebinned by bin_size (as in
+        SASM.setBinning). None if all bins are used. '''
+
+    n_raw = n_bins - trim
+    n_binned = n_raw // bin_size
+
+    def toBin(idx):
+        # setBinning keeps the points that do not fill a whole bin at the end
+        if idx <= n_binned:
+            return idx * bin_size
+        return n_binned * bin_size + idx - n_binned
+
+    n_points = n_binned + n_raw - n_binned * bin_size
+
+    first_bin = toBin(min(max(start_point, 0), n_points))
+    last_bin = toBin(max(n_points - max(end_point, 0), 0))
+
+    if first_bin <= 0 and last_bin >= n_raw:
+        return None
+
+    return (first_bin, max(first_bin, last_bin))
+
+def radialAverage(in_image, x_cin, y_cin, mask = None, readoutNoise_mask = None, dezingering = 0, dezing_sensitivity = 4.0, geometry = None,
+                  dezing_spread = 'Std', workers = 1, dtype = np.float64, backend = 'Auto', mode = 'Mean',
+                  clip_sigma = 3.0, clip_iterations = 5):
+    ''' Radial averaging. and calculation of readout noise from a readout noise mask.
+        It also returns the errorbars assuming possion distributed data
+
+        in_image :     Input image
+        dim:           Image dimentions
+        x_c, y_c :     (x_c, y_c) Center coordinate in the image (Pixels)
+        q_range :      q_range specifying [low_q high_q]
+        geometry :     RadialGeometry matching the image, center and masks,
+                       e.g. from a GeometryCache. Built here if not given.
+        dezing_spread : 'Std' or 'MAD', the spread used to find zingers
+        workers :      Number of threads used to integrate large images
+        dtype :        Accumulation dtype of the bins, np.float64 or np.float32.
+                       The image is read in its own dtype.
+        backend :      Name of the integration backend (see integration_backends),
+                       or 'Auto' for the fastest one for the geometry.
+        mode :         'Mean', or 'Median' or 'SigmaClip' for an outlier
+                       resistant average of each bin (see integrateRobust).
+                       The backend and dezingering are not used then.
+        clip_sigma, clip_iterations : Sigma clipping parameters for
+                       mode = 'SigmaClip'
+
+    '''
+
+    ylen, xlen = in_image.shape
+
+    xlen = int(xlen)
+    ylen = int(ylen)
+
+    if geometry is None:
+        geometry = RadialGeometry(in_image.shape, x_cin, y_cin, mask, readoutNoise_mask)
+    elif geometry.radius_edges is not None:
+        raise ValueError('Geometries with radius_edges are integrated with radialAverageQ.')
+
+    if geometry.readout_indices is None:
+        readoutNoiseFound = 0
+    else:
+        readoutNoiseFound = 1
+
+    # This code is faulty.. x has been switched with y
+    x_c = float(y_cin)
+    y_c = float(x_cin)
+
+    print('Radial averaging in progress...',)
+
+    if mode != 'Mean':
+        hist, hist_count, readoutN = integrateRobust(in_image, geometry, mode, clip_sigma, clip_iterations)
+        dezingering = 0
+    else:
+        if backend == 'Auto':
+            backend = selectIntegrationBackend(in_image, geometry, workers, dtype)
+        elif backend not in integration_backends:
+            raise ValueError('Unknown integration backend: ' + str(backend))
+
+        hist, hist_count, readoutN = integration_backends[backend](in_image, geometry, workers, dtype)
+
+    # The pixel values per bin are only needed for dezingering
+    if dezingering == 1:
+        qmatrix = dezingerBinValues(geometry.getBinValues(in_image), dezing_sensitivity, dezing_spread)
+    else:
+        qmatrix = None
+
+    print('done')
+
+    # print(np.any(hist<0))
+    # print(np.any(hist_count<0))
+
+    hist_cnt = hist_count[2,:]    #contains x-mean
+
+    hist_count = hist_count[0,:]  #contains N
+
+    std_i = np.sqrt(hist_cnt/hist_count)
+
+    std_i[np.where(np.isnan(std_i))] = 0
+
+    iq = hist / hist_count
+
+    # print(iq)
+
+    if x_c > 0 and x_c < xlen and y_c > 0 and y_c < ylen:
+        iq[0] = in_image[int(round(x_c)), int(round(y_c))]  #the center is not included in the radial average, so it is set manually her
+
+
+    #Estimated Standard deviation   - equal to the std of pixels in the area / sqrt(N)
+    errorbars = std_i / np.sqrt(hist_count)
+
+
+    if readoutNoiseFound:
+        #Average readoutNoise
+        readoutNoise = readoutN[0,1] /  readoutN[0,0]   ## sum(img(x,y)) / N
+        print('Readout Noise: ', readoutNoise)
+
+        #Estimated Standard deviation   - equal to the std of pixels in the area / sqrt(N)
+        std_n = np.sqrt(readoutN[0,3] / readoutN[0,0])    # sqrt((X-MEAN)/N)
+        errorbarNoise = std_n / np.sqrt(readoutN[0,0])
+
+        print('Readout Noise Err: ', errorbarNoise)
+
+        #Readoutnoise average subtraction
+        iq = iq - readoutNoise
+        errorbars = np.sqrt(np.power(errorbars, 2) + np.power(errorbarNoise, 2))
+
+
+    iq[np.where(np.isnan(iq))] = 0
+    errorbars[np.where(np.isnan(errorbars))] = 1e-10
+
+    q = np.linspace(0, len(iq)-1, len(iq))
+
+    if dezingering == 1:
+        iq, errorbars = getIntensityFromQmatrix(qmatrix)
+        iq[np.where(np.isnan(iq))] = 0
+        errorbars[np.where(np.isnan(errorbars))] = 1e-10
+
+    #Trim trailing zeros
+    # iq = np.trim_zeros(iq, 'b')
+    iq = iq[:-5]        #Last points are usually garbage they're very few pixels
+                        #Cutting the last 5 points here.
+    q = q[0:len(iq)]
+    errorbars = errorbars[0:len(iq)]
+
+    return [iq, q, errorbars, qmatrix]
+
+
+def radialAverageStack(frames, geometry):
+    ''' Radial average of a stack of frames with the same shape, center and
+        masks. Gives the same result as calling radialAverage on every frame
+        (without dezingering), but the bin lookup and the bookkeeping are
+        only done once for the whole stack.
+
+        frames :     (n_frames, ylen, xlen) array or list of images
+        geometry :   RadialGeometry for the frames
+
+        Returns [iq, q, errorbars], where iq and errorbars are
+        (n_frames, n_bins) matrices.
+    '''
+
+    n_frames = len(frames)
+
+    ylen, xlen = geometry.img_dim
+    n_bins = len(geometry.counts)
+
+    hist = np.zeros((n_frames, n_bins), dtype = np.float64)
+    m2 = np.zeros((n_frames, n_bins), dtype = np.float64)
+    center_values = np.zeros(n_frames, dtype = np.float64)
+
+    readoutNoiseFound = geometry.readout_indices is not None
+    readoutN = np.zeros((n_frames, 4), dtype = np.float64)
+
+    n = geometry.counts.astype(np.float64)
+    filled = geometry.counts > 0
+
+    bin_map = geometry.getBinMap()
+
+    # This code is faulty.. x has been switched with y
+    x_c = geometry.center[1]
+    y_c = geometry.center[0]
+
+    has_center = x_c > 0 and x_c < xlen and y_c > 0 and y_c < ylen
+
+    print('Radial averaging of %i frames in progress...' %(n_frames))
+
+    for frame_idx in range(n_frames):
+        frame = frames[frame_idx]
+
+        if frame.shape != geometry.img_dim:
+            raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+        flat_img = np.ravel(frame).astype(np.float64)
+
+        # The last bin of the map collects the rejected pixels
+        frame_hist = np.bincount(bin_map, weights = flat_img, minlength = n_bins+1)
+
+        mean = np.zeros(n_bins+1, dtype = np.float64)
+        np.divide(frame_hist[:-1], n, out = mean[:-1], where = filled)
+
+        flat_img -= mean.take(bin_map)
+        flat_img **= 2
+
+        hist[frame_idx] = frame_hist[:-1]
+        m2[frame_idx] = np.bincount(bin_map, weights = flat_img, minlength = n_bins+1)[:-1]
+
+        if has_center:
+            center_values[frame_idx] = frame[int(round(x_c)), int(round(y_c))]
+
+        if readoutNoiseFound:
+            readoutN[frame_idx] = geometry.getReadoutNoise(np.ravel(frame))[0]
+
+    print('done')
+
+    if not readoutNoiseFound:
+        readoutN = None
+
+    if not has_center:
+        center_values = None
+
+    return calcRadialProfile(hist, n, m2, readoutN, center_values)
+
+def calcRadialProfile(hist, n, m2, readoutN = None, center_value = None, trim = 5):
+    ''' Intensity, q and errorbars from the sums of the pixels in each q-bin,
+        with the same corrections as radialAverage.
+
+        hist :          Sum of the pixel values in each bin
+        n :             Number of pixels in each bin
+        m2 :            Sum of squared deviations from the mean in each bin
+        readoutN :      N, sum, mean and M2 of the readout noise pixels, or None
+        center_value :  Value of the center pixel, used for the first point
+        trim :          Number of points cut from the end of the profile
+
+        hist and m2 can hold one profile per row, with matching rows of
+        readoutN and center_value.
+    '''
+
+    n_bins = hist.shape[-1]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        std_i = np.sqrt(m2 / n)
+        std_i[np.where(np.isnan(std_i))] = 0
+
+        iq = hist / n
+
+        if center_value is not None:
+            iq[..., 0] = center_value
+
+        errorbars = std_i / np.sqrt(n)
+
+        if readoutN is not None:
+            readoutNoise = readoutN[..., 1] / readoutN[..., 0]
+
+            std_n = np.sqrt(readoutN[..., 3] / readoutN[..., 0])
+            errorbarNoise = std_n / np.sqrt(readoutN[..., 0])
+
+            iq = iq - readoutNoise[..., np.newaxis]
+            errorbars = np.sqrt(np.power(errorbars, 2) + np.power(errorbarNoise[..., np.newaxis], 2))
+
+    iq[np.where(np.isnan(iq))] = 0
+    errorbars[np.where(np.isnan(errorbars))] = 1e-10
+
+    q = np.linspace(0, n_bins-1, n_bins)
+
+    #Cutting the last 5 points, as in radialAverage
+    iq = iq[..., :n_bins-trim]
+    q = q[0:iq.shape[-1]]
+    errorbars = errorbars[..., 0:iq.shape[-1]]
+
+    return [iq, q, errorbars]
+
+def calcQBinEdges(q_min, q_max, n_bins, spacing = 'Linear'):
+    ''' Returns n_bins+1 q-bin edges from q_min to q_max, spaced 'Linear'
+        or 'Log' (q_min must then be larger than 0) '''
+
+    if spacing == 'Linear':
+        return np.linspace(q_min, q_max, n_bins+1)
+    elif spacing == 'Log':
+        if q_min <= 0:
+            raise ValueError('Log spaced q-bins need q_min > 0.')
+        return np.logspace(np.log10(q_min), np.log10(q_max), n_bins+1)
+    else:
+        raise ValueError('Unknown q-bin spacing: ' + str(spacing))
+
+def radialAverageQ(in_image, geometry, calibration, workers = 1, dtype = np.float64, mode = 'Mean',
+                   clip_sigma = 3.0, clip_iterations = 5):
+    ''' Radial average straight into the q-bins of a geometry built with
+        radius_edges, e.g. from calcQBinEdges converted to pixels with
+        SASCalib.calcPixelsFromQ. No rebinning or q calibration is needed
+        afterwards.
+
+        in_image :     Input image
+        geometry :     RadialGeometry with radius_edges
+        calibration :  (sd_distance, pixel_size, wavelength), as for
+                       SASM.calibrateQ
+        workers, dtype, mode, clip_sigma, clip_iterations : as for radialAverage
+
+        Returns [iq, q, errorbars] for the bins that have pixels. q (1/A)
+        is the q of the mean distance of the bin pixels from the center, the
+        errorbars are the std of the bin pixels / sqrt(N), with the readout
+        noise subtracted as in radialAverage.
+    '''
+
+    if geometry.radius_edges is None:
+        raise ValueError('The geometry has no radius_edges.')
+
+    if mode != 'Mean':
+        hist, hist_count, readoutN = integrateRobust(in_image, geometry, mode, clip_sigma, clip_iterations)
+    else:
+        hist, hist_count, readoutN = geometry.integrate(in_image, workers, dtype)
+
+    if geometry.readout_indices is None:
+        readoutN = None
+    else:
+        readoutN = readoutN[0]
+
+    iq, q, errorbars = calcRadialProfile(hist, hist_count[0], hist_count[2], readoutN, trim = 0)
+
+    filled = hist_count[0] > 0
+
+    sd_distance, pixel_size, wavelength = calibration
+    q = SASCalib.calcQFromPixels(geometry.bin_radius[filled], sd_distance, pixel_size, wavelength)
+
+    return [iq[filled], q, errorbars[filled]]
+
+def radialAverageCake(in_image, geometry, n_chi = 36, chi_ranges = None):
+    ''' Regroups the pixels of the radial average into (q, chi) bins, using
+        the q-bins of the geometry. chi is the azimuthal angle in degrees,
+        from -180 to 180, measured counterclockwise from the x axis of the
+        image as displayed in RAW (origin in the lower left corner).
+
+        in_image :    Input image
+        geometry :    RadialGeometry for the image
+        n_chi :       Number of chi bins of the cake
+        chi_ranges :  List of (chi_min, chi_max) sectors to calculate 1D
+                      profiles for. chi_min > chi_max gives a sector that
+                      wraps around +-180.
+
+        Returns cake, q, chi, sectors: the (n_q, n_chi) mean intensity, the q
+        (in pixels) and chi (center of the chi bins) axes, and a list with
+        [iq, q, errorbars] for each sector, as from radialAverage.
+    '''
+
+    if in_image.shape != geometry.img_dim:
+        raise SASExceptions.MaskSizeError('Image does not fit the integration geometry.')
+
+    ylen, xlen = geometry.img_dim
+    n_bins = len(geometry.counts)
+
+    flat_img = np.ravel(in_image)
+    values = flat_img.take(geometry.indices).astype(np.float64)
+
+    chi = geometry.getChi()
+    bins = geometry.bins
+
+    chi_edges = np.linspace(-180., 180., n_chi+1)
+    chi_bins = np.clip(np.searchsorted(chi_edges, chi, side = 'right') - 1, 0, n_chi-1)
+
+    cake_bins = bins * n_chi + chi_bins
+
+    cake_sum = np.bincount(cake_bins, weights = values, minlength = n_bins*n_chi)
+    cake_count = np.bincount(cake_bins, minlength = n_bins*n_chi)
+
+    cake = np.zeros(n_bins*n_chi, dtype = np.float64)
+    np.divide(cake_sum, cake_count, out = cake, where = cake_count > 0)
+    cake = cake.reshape(n_bins, n_chi)[:-5]
+
+    q = np.linspace(0, n_bins-1, n_bins)[:cake.shape[0]]
+    chi_centers = (chi_edges[:-1] + chi_edges[1:]) / 2.
+
+    if chi_ranges is None:
+        chi_ranges = []
+
+    if geometry.readout_indices is not None:
+        readoutN = geometry.getReadoutNoise(flat_img)[0]
+    else:
+        readoutN = None
+
+    # This code is faulty.. x has been switched with y
+    x_c = geometry.center[1]
+    y_c = geometry.center[0]
+
+    if x_c > 0 and x_c < xlen and y_c > 0 and y_c < ylen:
+        center_value = in_image[int(round(x_c)), int(round(y_c))]
+    else:
+        center_value = None
+
+    sectors = []
+
+    for chi_min, chi_max in chi_ranges:
+        if chi_min <= chi_max:
+            in_sector = np.logical_and(chi >= chi_min, chi < chi_max)
+        else:
+            in_sector = np.logical_or(chi >= chi_min, chi < chi_max)
+
+        sector_bins = bins[in_sector]
+        sector_values = values[in_sector]
+
+        hist = np.bincount(sector_bins, weights = sector_values, minlength = n_bins)
+        n = np.bincount(sector_bins, minlength = n_bins).astype(np.float64)
+
+        mean = np.zeros(n_bins, dtype = np.float64)
+        np.divide(hist, n, out = mean, where = n > 0)
+
+        m2 = np.bincount(sector_bins, weights = (sector_values - mean[sector_bins])**2, minlength = n_bins)
+
+        sectors.append(calcRadialProfile(hist, n, m2, readoutN, center_value))
+
+    return cake, q, chi_centers, sectors
+
+def createAzimuthalIntegrator(img_dim, x_c, y_c, mask = None, calibration = None, flatfield_filename = None):
+    ''' Sets up a pyFAI AzimuthalIntegrator for images of shape img_dim.
+
+        mask :                RAW mask (1 for the pixels to use), or None
+        calibration :         (sample detector distance [mm], pixel size [m],
+                              wavelength [m]), or None to leave it uncalibrated
+        flatfield_filename :  Flatfield image file, or None
+    '''
+
+    ai = pyFAI.AzimuthalIntegrator()
+
+    if calibration is not None:
+        sd_distance, pixel_size, wavelength = calibration
+
+        ai.wavelength = wavelength
+        ai.pixel1 = pixel_size
+        ai.pixel2 = pixel_size
+        ai.setFit2D(sd_distance, x_c, y_c)
+
+    if flatfield_filename is not None:
+        ai.set_flatfiles(flatfield_filename)
+
+    # pyFAI masks the pixels that are non zero
+    if mask is not None:
+        ai.detector.mask = np.logical_not(mask).astype(np.int8)
+
+    print(ai)
+
+    return ai
+
+def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings, mask = None, tbs_mask = None,
+                                     geometry_cache = None):
+    ''' Integrates, calibrates and normalizes an image with pyFAI.
+    geometry_cache is a GeometryCache to reuse the integrator between images. '''
+
+    print('using pyfai!!!!')
+    # Get appropriate settings
+    sd_distance = raw_settings.get('SampleDistance')
+    pixel_size = raw_settings.get('DetectorPixelSize')
+    wavelength = raw_settings.get('WaveLength')
+    bin_size = raw_settings.get('Binsize')
+    normlist = raw_settings.get('NormalizationList')
+
+    do_calibration = raw_settings.get('CalibrateMan')
+    do_normalization = raw_settings.get('EnableNormalization')
+    do_flatfield = raw_settings.get('NormFlatfieldEnabled')
+    do_solidangle = raw_settings.get('DoSolidAngleCorrection')
+    do_useheaderforcalib = raw_settings.get('UseHeaderForCalib')
+
+    #Put everything in appropriate units
+    pixel_size = pixel_size *1e-6 #convert pixel size to m
+    wavelength = wavelength*1e-10 #convert wl to m
+
+    if do_useheaderforcalib:
+        img_hdr = parameters['imageHeader']
+        file_hdr = parameters['counters']
+
+        result = getBindListDataFromHeader(raw_settings, img_hdr, file_hdr, keys = ['Sample Detector Distance', 'Detector Pixel Size', 'Wavelength'])
+        if result[0] is not None: sd_distance = result[0]
+        if result[1] is not None: pixel_size = result[1]
+        if result[2] is not None: wavelength = result[2]
+
+    # Find the maximum distance to the edge in the image:
+    maxlen = calcMaxRadius(img.shape, x_cin, y_cin)
+
+    x_c = float(x_cin)
+    y_c = float(y_cin)
+
+    if do_calibration:
+        calibration = (sd_distance, pixel_size, wavelength)
+    else:
+        calibration = None
+
+    if do_flatfield:
+        flatfield_filename = raw_settings.get('NormFlatfieldFile')
+    else:
+        flatfield_filename = None
+
+    # The mask is set on the integrator, so pyFAI can keep its integration engine
+    if geometry_cache is not None:
+        ai = geometry_cache.getAzimuthalIntegrator(img.shape, x_c, y_c, mask, calibration, flatfield_filename)
+    else:
+        ai = createAzimuthalIntegrator(img.shape, x_c, y_c, mask, calibration, flatfield_filename)
 
-    print(ai)
     qmin_theta = SASCalib.calcTheta(sd_distance*1e-3, pixel_size, 0)
     qmin = ((4 * math.pi * math.sin(qmin_theta)) / (wavelength*1e10))
 
@@ -1121,7 +2450,7 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
     q_range = (qmin, qmax)
 
     #Carry out the integration
-    q, iq, errorbars = ai.integrate1d(img, maxlen, mask = mask, correctSolidAngle = do_solidangle, error_model = 'poisson', unit = 'q_A^-1', radial_range = q_range, method = 'nosplit_csr')
+    q, iq, errorbars = ai.integrate1d(img, maxlen, correctSolidAngle = do_solidangle, error_model = 'poisson', unit = 'q_A^-1', radial_range = q_range, method = 'nosplit_csr')
 
     i_raw = iq[:-5]        #Last points are usually garbage they're very few pixels
                         #Cutting the last 5 points here.
@@ -1131,7 +2460,7 @@ def pyFAIIntegrateCalibrateNormalize(img, parameters, x_cin, y_cin, raw_settings
     err_raw_non_nan = np.nan_to_num(errorbars)
 
     if tbs_mask is not None:
-        roi_counter = img[tbs_mask==1].sum()
+        roi_counter = calcMaskedSum(img, tbs_mask)
         parameters['counters']['roi_counter'] = roi_counter
 
     parameters['normalizations'] = {}
@@ -1202,7 +2531,7 @@ def ravg_python(readoutNoiseFound, readoutN, readoutNoise_mask, xlen, ylen, x_c,
 
     data = qmatrix            #/* Pointer to the numpy array version of qmatrix */
 
-    half_window_size = (WINDOW_LENGTH / 2.0)
+    half_window_size = int(WINDOW_LENGTH / 2.0)
     win_len = WINDOW_LENGTH
 
     for x in range(xlen):
@@ -1223,8 +2552,9 @@ def ravg_python(readoutNoiseFound, readoutN, readoutNoise_mask, xlen, ylen, x_c,
 
                     hist[r] = hist[r] + in_image[x,y]                    #/* Integration of pixel values */
 
-                    qmat_cnt = hist_count[0, q_idx]                      #/* Number of pixels in a bin */
-                    qmatrix[q_idx, int(qmat_cnt)] = in_image[x,y]        #/* Save pixel value for later analysis */
+                    if dezingering == 1:
+                        qmat_cnt = hist_count[0, q_idx]                  #/* Number of pixels in a bin */
+                        qmatrix[q_idx, int(qmat_cnt)] = in_image[x,y]    #/* Save pixel value for later analysis */
 
                     hist_count[0, q_idx] = hist_count[0, q_idx] + 1      #/* Number of pixels in a bin */
 
@@ -0,0 +1,152 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+'''
+Decompression of CCP4 packed (Mar345) images, used by
+SASFileIO.loadMar345Image when fabio is not available. Build it with
+SASbuild_Clibs.py.
+
+Port of unpack_word from the CCP4 pack_c.c by Jan Pieter Abrahams.
+'''
+
+import re
+
+cdef int bitdecode[8]
+bitdecode[:] = [0, 4, 5, 6, 7, 8, 16, 32]
+
+
+cdef inline unsigned int setbits(int n) noexcept nogil:
+    if n >= 32:
+        return 0xFFFFFFFFu
+    return (1u << n) - 1u
+
+
+cdef inline unsigned int shiftLeft(unsigned int x, int n) noexcept nogil:
+    if n >= 32:
+        return 0
+    return (x & setbits(32 - n)) << n
+
+
+cdef inline unsigned int shiftRight(unsigned int x, int n) noexcept nogil:
+    if n >= 32:
+        return 0
+    return (x >> n) & setbits(32 - n)
+
+
+cdef int unpackWord(const unsigned char[:] packed, int x, int y, short[:] img) noexcept nogil:
+    ''' Returns the number of decoded pixels '''
+
+    cdef int valids = 0, spillbits = 0, usedbits, bitnum, pixnum
+    cdef int total = x * y
+    cdef int pixel = 0, pos = 0
+    cdef int packed_len = packed.shape[0]
+    cdef unsigned int window = 0, spill = 0
+    cdef int nextint
+
+    while pixel < total:
+        if valids < 6:
+            if spillbits > 0:
+                window |= shiftLeft(spill, valids)
+                valids += spillbits
+                spillbits = 0
+            else:
+                if pos >= packed_len:
+                    return pixel
+                spill = packed[pos]
+                pos += 1
+                spillbits = 8
+        else:
+            pixnum = 1 << (window & setbits(3))
+            window = shiftRight(window, 3)
+            bitnum = bitdecode[window & setbits(3)]
+            window = shiftRight(window, 3)
+            valids -= 6
+
+            while pixnum > 0 and pixel < total:
+                if valids < bitnum:
+                    if spillbits > 0:
+                        window |= shiftLeft(spill, valids)
+                        if (32 - valids) > spillbits:
+                            valids += spillbits
+                            spillbits = 0
+                        else:
+                            usedbits = 32 - valids
+                            spill = shiftRight(spill, usedbits)
+                            spillbits -= usedbits
+                            valids = 32
+                    else:
+                        if pos >= packed_len:
+                            return pixel
+                        spill = packed[pos]
+                        pos += 1
+                        spillbits = 8
+                else:
+                    pixnum -= 1
+
+                    if bitnum == 0:
+                        nextint = 0
+                    else:
+                        nextint = <int> (window & setbits(bitnum))
+                        valids -= bitnum
+                        window = shiftRight(window, bitnum)
+                        if (nextint & (1 << (bitnum - 1))) != 0:
+                            nextint = <int> (<unsigned int> nextint | ~setbits(bitnum))
+
+                    if pixel > x:
+                        img[pixel] = <short> (nextint + (img[pixel-1] + img[pixel-x+1]
+                            + img[pixel-x] + img[pixel-x-1] + 2) / 4)
+                    elif pixel != 0:
+                        img[pixel] = <short> (img[pixel-1] + nextint)
+                    else:
+                        img[pixel] = <short> nextint
+
+                    pixel += 1
+
+    return pixel
+
+
+def packc(filename, int size, short[:] img):
+    ''' Unpacks the CCP4 packed image in filename into the flat int16 array
+    img of length size*size. Returns the number of decoded pixels. '''
+
+    cdef int x, y, decoded
+
+    with open(filename, 'rb') as packed_file:
+        data = packed_file.read()
+
+    match = re.search(br'CCP4 packed image, X: *(\d+), Y: *(\d+)\n', data)
+
+    if match is None:
+        raise IOError('No CCP4 packed image found in ' + repr(filename))
+
+    x = int(match.group(1))
+    y = int(match.group(2))
+
+    if x * y > img.shape[0] or x * y > size * size:
+        raise ValueError('Packed image is larger than the output array')
+
+    cdef const unsigned char[:] packed = data[match.end():]
+
+    with nogil:
+        decoded = unpackWord(packed, x, y, img)
+
+    if decoded < x * y:
+        raise IOError('Unexpected end of file in ' + repr(filename))
+
+    return decoded
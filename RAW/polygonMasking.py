@@ -39,24 +39,10 @@ RAW_DIR = os.path.dirname(os.path.abspath(__file__))
 if RAW_DIR not in sys.path:
     sys.path.append(RAW_DIR)
 import RAWGlobals
-#from scipy.weave import ext_tools
-#from scipy.weave import converters
 
-#Check for compiled extensions. If compilation hasn't already failed, try to
-#compile them if they are missing
+#Use the compiled extension if it has been built with SASbuild_Clibs.py
 if RAWGlobals.compiled_extensions:
-    try:
-        import polygonmask_ext
-
-    except ImportError:
-        import SASbuild_Clibs
-        try:
-            SASbuild_Clibs.buildAll()
-            import polygonmask_ext
-
-        except Exception as error:
-            RAWGlobals.compiled_extensions = False
-            print(error)
+    import polygonmask_ext
 
 def npnpoly(verts,points):
     if RAWGlobals.compiled_extensions:
@@ -69,62 +55,6 @@ def npnpoly(verts,points):
         y = np.ascontiguousarray(points[:,1])
         out = np.empty(len(points),dtype=np.uint8)
 
-#        mod = ext_tools.ext_module('polygonmask_ext')
-#
-        code = """
-        /* Code from:
-           http://www.ecse.rpi.edu/Homepages/wrf/Research/Short_Notes/pnpoly.html
-
-           Copyright (c) 1970-2003, Wm. Randolph Franklin
-
-           Permission is hereby granted, free of charge, to any person
-           obtaining a copy of this software and associated documentation
-           files (the "Software"), to deal in the Software without
-           restriction, including without limitation the rights to use, copy,
-           modify, merge, publish, distribute, sublicense, and/or sell copies
-           of the Software, and to permit persons to whom the Software is
-           furnished to do so, subject to the following conditions:
-
-        1. Redistributions of source code must retain the above
-                 copyright notice, this list of conditions and the following
-                 disclaimers.
-        2. Redistributions in binary form must reproduce the above
-                 copyright notice in the documentation and/or other materials
-                 provided with the distribution.
-        3. The name of W. Randolph Franklin may not be used to endorse
-                 or promote products derived from this Software without
-                 specific prior written permission.
-
-           THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
-           EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
-           MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
-           NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
-           BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
-           ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
-           CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-           SOFTWARE. */
-
-        int i,j,n;
-        unsigned int c;
-        int nr_verts = Nxp[0];
-        for (n = 0; n < Nx[0]; n++) {
-            c = 0;
-        for (i = 0, j = nr_verts-1; i < nr_verts; j = i++) {
-                if ((((yp(i)<=y(n)) && (y(n)<yp(j))) ||
-                  ((yp(j)<=y(n)) && (y(n)<yp(i)))) &&
-                (x(n) < (xp(j) - xp(i)) * (y(n) - yp(i)) / (yp(j) - yp(i)) + xp(i)))
-
-        c = !c;
-        }
-    out(n) = c;
-        }
-        """
-        #weave.inline(code, ['xp','yp','x','y','out'], type_converters=weave.converters.blitz)
-
-#        polymsk = ext_tools.ext_function('polymsk', code, ['xp','yp','x','y','out'], type_converters = converters.blitz)
-#        mod.add_function(polymsk)
-#        mod.compile(compiler = 'gcc')
-
         polygonmask_ext.polymsk(xp, yp, x, y, out)
 
         return out
@@ -136,20 +66,78 @@ def npnpoly(verts,points):
 
         See http://www.ecse.rpi.edu/Homepages/wrf/Research/Short_Notes/pnpoly.html
         """
-        out = []
-
         xpi = verts[:,0]
         ypi = verts[:,1]
         # shift
         xpj = xpi[np.arange(xpi.size)-1]
         ypj = ypi[np.arange(ypi.size)-1]
-        maybe = np.empty(len(xpi),dtype=bool)
-        for x,y in points:
-            maybe[:] = ((ypi <= y) & (y < ypj)) | ((ypj <= y) & (y < ypi))
-            out.append(sum(x < (xpj[maybe]-xpi[maybe])*(y - ypi[maybe]) \
-                           / (ypj[maybe] - ypi[maybe]) + xpi[maybe]) % 2)
 
-        return np.asarray(out,dtype=bool)
+        x = points[:,0]
+        y = points[:,1]
+
+        # loop over the (few) edges, each edge toggles all points left of it
+        out = np.zeros(len(points), dtype=bool)
+        for i in range(len(xpi)):
+            maybe = ((ypi[i] <= y) & (y < ypj[i])) | ((ypj[i] <= y) & (y < ypi[i]))
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                maybe &= x < (xpj[i]-xpi[i])*(y - ypi[i]) / (ypj[i] - ypi[i]) + xpi[i]
+
+            out ^= maybe
+
+        return out
+
+def fillPolygon(verts, shape):
+    """Returns a boolean matrix of size shape = (rows, cols) which is True
+    at the pixels inside the polygon. Pixel [y, x] is the point (x, y), the
+    same even-odd rule as npnpoly is used.
+
+    Only the rows and columns of the polygon bounding box are evaluated, one
+    scanline at a time: the edge crossings of each row are calculated and
+    every pixel is toggled once for each crossing to its right.
+    """
+    rows, cols = shape
+    fill = np.zeros(shape, dtype=bool)
+
+    verts = np.asarray(verts, dtype=np.float64)
+    xpi = verts[:,0]
+    ypi = verts[:,1]
+    # shift
+    xpj = xpi[np.arange(xpi.size)-1]
+    ypj = ypi[np.arange(ypi.size)-1]
+
+    y_start = max(int(np.ceil(ypi.min())), 0)
+    y_stop = min(int(np.floor(ypi.max())) + 1, rows)
+    x_start = max(int(np.floor(xpi.min())), 0)
+    x_stop = min(int(np.ceil(xpi.max())) + 1, cols)
+
+    if y_start >= y_stop or x_start >= x_stop:
+        return fill
+
+    nrows = y_stop - y_start
+    width = x_stop - x_start
+
+    y = np.arange(y_start, y_stop, dtype=np.float64)[:,np.newaxis]
+
+    crosses = ((ypi <= y) & (y < ypj)) | ((ypj <= y) & (y < ypi))
+    row_idx, edge_idx = np.nonzero(crosses)
+
+    y = y[row_idx, 0]
+    x_cross = ((xpj[edge_idx]-xpi[edge_idx])*(y - ypi[edge_idx])
+               / (ypj[edge_idx] - ypi[edge_idx]) + xpi[edge_idx])
+
+    # integer x < x_cross  <=>  x < ceil(x_cross)
+    toggle = np.clip(np.ceil(x_cross), x_start, x_stop).astype(int) - x_start
+
+    counts = np.bincount(row_idx*(width+1) + toggle, minlength = nrows*(width+1))
+    counts = counts.reshape(nrows, width+1)
+
+    # number of crossings right of each pixel
+    right = np.cumsum(counts[:,::-1], axis=1)[:,::-1]
+
+    fill[y_start:y_stop, x_start:x_stop] = right[:,1:] % 2 == 1
+
+    return fill
 
 
 
@@ -189,6 +177,10 @@ class Polygeom(np.ndarray):
                "Points should be of shape Nx2, is %s" % str(points.shape)
         return npnpoly(self.verts,points).astype(bool)
 
+    def rasterize(self, shape):
+        """Boolean matrix of size shape = (rows, cols), True inside the polygon"""
+        return fillPolygon(self.verts, shape)
+
     def get_area(self):
         """
         Return the area of the polygon.
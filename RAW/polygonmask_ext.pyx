@@ -0,0 +1,80 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+'''
+Compiled point in polygon test used by polygonMasking.npnpoly, build it
+with SASbuild_Clibs.py.
+
+Code from:
+http://www.ecse.rpi.edu/Homepages/wrf/Research/Short_Notes/pnpoly.html
+
+Copyright (c) 1970-2003, Wm. Randolph Franklin
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use, copy,
+modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+1. Redistributions of source code must retain the above
+   copyright notice, this list of conditions and the following
+   disclaimers.
+2. Redistributions in binary form must reproduce the above
+   copyright notice in the documentation and/or other materials
+   provided with the distribution.
+3. The name of W. Randolph Franklin may not be used to endorse
+   or promote products derived from this Software without
+   specific prior written permission.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+
+def polymsk(double[:] xp, double[:] yp, double[:] x, double[:] y, unsigned char[:] out):
+    ''' Sets out[n] to 1 if the point (x[n], y[n]) is inside the polygon
+    with vertices (xp, yp), 0 otherwise '''
+
+    cdef int i, j, n
+    cdef unsigned char c
+    cdef int nr_verts = xp.shape[0]
+    cdef int nr_points = x.shape[0]
+
+    with nogil:
+        for n in range(nr_points):
+            c = 0
+            j = nr_verts - 1
+
+            for i in range(nr_verts):
+                if ((((yp[i] <= y[n]) and (y[n] < yp[j])) or
+                     ((yp[j] <= y[n]) and (y[n] < yp[i]))) and
+                    (x[n] < (xp[j] - xp[i]) * (y[n] - yp[i]) / (yp[j] - yp[i]) + xp[i])):
+                    c = not c
+
+                j = i
+
+            out[n] = c
@@ -0,0 +1,124 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+#******************************************************************************
+# This file is part of RAW.
+#
+#    RAW is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    RAW is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with RAW.  If not, see <http://www.gnu.org/licenses/>.
+#
+#******************************************************************************
+
+'''
+Compiled radial average. Same arguments and results as SASImage.ravg_python,
+build it with SASbuild_Clibs.py.
+'''
+
+from libc.math cimport sqrt
+from libc.stdlib cimport qsort
+
+cdef enum:
+    WINDOW_LENGTH = 30
+
+
+cdef int compareDoubles(const void *a, const void *b) noexcept nogil:
+    cdef double diff = (<double *> a)[0] - (<double *> b)[0]
+
+    if diff < 0:
+        return -1
+    elif diff > 0:
+        return 1
+    return 0
+
+
+cdef void dezingerPoint(double[:, :] qmatrix, int q_idx, int point_idx, int replace_idx,
+                        double dezing_sensitivity) noexcept nogil:
+    ''' Replaces qmatrix[q_idx, replace_idx] with the median of the window
+    qmatrix[q_idx, point_idx-WINDOW_LENGTH:point_idx] if it is larger than
+    median + dezing_sensitivity * std of the window '''
+
+    cdef double window[WINDOW_LENGTH]
+    cdef double mean = 0, variance = 0, median, std
+    cdef int i
+
+    for i in range(WINDOW_LENGTH):
+        window[i] = qmatrix[q_idx, point_idx - WINDOW_LENGTH + i]
+        mean += window[i]
+
+    mean = mean / WINDOW_LENGTH
+
+    for i in range(WINDOW_LENGTH):
+        variance += (window[i] - mean) * (window[i] - mean)
+
+    std = sqrt(variance / WINDOW_LENGTH)
+
+    qsort(window, WINDOW_LENGTH, sizeof(double), compareDoubles)
+    median = (window[WINDOW_LENGTH // 2 - 1] + window[WINDOW_LENGTH // 2]) / 2.
+
+    if qmatrix[q_idx, replace_idx] > median + dezing_sensitivity * std:
+        qmatrix[q_idx, replace_idx] = median
+
+
+def ravg(int readoutNoiseFound, double[:, :] readoutN, double[:, :] readoutNoise_mask,
+         int xlen, int ylen, double x_c, double y_c, double[:] hist, int low_q, int high_q,
+         double[:, :] in_image, double[:, :] hist_count, double[:, :] mask, double[:, :] qmatrix,
+         int dezingering, double dezing_sensitivity):
+
+    cdef int x, y, r, q_idx, point_idx, i
+    cdef int half_window_size = WINDOW_LENGTH // 2
+    cdef int hist_length = hist.shape[0]
+    cdef double rel_x, rel_y, value, delta, deltaN
+
+    with nogil:
+        for x in range(xlen):
+            for y in range(ylen):
+                rel_x = x - x_c
+                rel_y = y_c - y
+
+                r = <int> sqrt(rel_y*rel_y + rel_x*rel_x)
+
+                value = in_image[x, y]
+
+                if r < high_q and r > low_q and mask[x, y] == 1:
+                    q_idx = r
+
+                    hist[r] = hist[r] + value                                   # Integration of pixel values
+
+                    if dezingering == 1:
+                        qmatrix[q_idx, <int> hist_count[0, q_idx]] = value       # Save pixel value for later analysis
+
+                    hist_count[0, q_idx] = hist_count[0, q_idx] + 1              # Number of pixels in a bin
+
+                    delta = value - hist_count[1, q_idx]                         # Calculation of variance start
+
+                    hist_count[1, q_idx] = hist_count[1, q_idx] + (delta / hist_count[0, q_idx])
+                    hist_count[2, q_idx] = hist_count[2, q_idx] + (delta * (value - hist_count[1, q_idx]))
+
+                    # Dezingering
+                    if dezingering == 1 and hist_count[0, q_idx] >= WINDOW_LENGTH:
+                        point_idx = <int> hist_count[0, q_idx]
+
+                        dezingerPoint(qmatrix, q_idx, point_idx, point_idx - half_window_size, dezing_sensitivity)
+
+                if readoutNoiseFound == 1 and r < high_q-1 and r > low_q and readoutNoise_mask[x, y] == 0:
+                    readoutN[0, 0] = readoutN[0, 0] + 1
+                    readoutN[0, 1] = readoutN[0, 1] + value
+
+                    deltaN = value - readoutN[0, 2]
+                    readoutN[0, 2] = readoutN[0, 2] + (deltaN / readoutN[0, 0])    # Running average
+                    readoutN[0, 3] = readoutN[0, 3] + (deltaN * (value - readoutN[0, 2]))
+
+        # Remove zingers at the first (window/2) points
+        if dezingering == 1:
+            for q_idx in range(hist_length):
+                if hist_count[0, q_idx] > (WINDOW_LENGTH + half_window_size):
+                    for i in range(WINDOW_LENGTH + half_window_size, WINDOW_LENGTH, -1):
+                        dezingerPoint(qmatrix, q_idx, i, i - WINDOW_LENGTH, dezing_sensitivity)
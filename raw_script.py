@@ -151,6 +151,10 @@ def check_essential_arguments(exp_config, config_file):
         'record_ext': '.log',
         'overwrite': False,
         'scale': 'ionchamber',
+        'load_processes': 1,
+        'prefetch_depth': 0,
+        'prefetch_max_bytes': 0,
+        'stream_frames': False,
     }
     existent_args = exp_config.keys()
 
@@ -214,6 +218,10 @@ def run_RAW(exp_config):
         'AutoSaveOnAvgFiles': True,
         'AutoSaveOnGnom': False,
         'DatHeaderOnTop': True,
+        'LoadProcesses': int(exp_config.get('load_processes', 1)),
+        'PrefetchDepth': int(exp_config.get('prefetch_depth', 0)),
+        'PrefetchMaxBytes': int(exp_config.get('prefetch_max_bytes', 0)),
+        'StreamImageFrames': bool(exp_config.get('stream_frames', False)),
     }
 
     raw_simulator = RAWSimulator(
@@ -330,6 +338,10 @@ def run_automatic(exp_config, log_file=sys.stdout):
         'AutoSaveOnAvgFiles': True,
         'AutoSaveOnGnom': False,
         'DatHeaderOnTop': True,
+        'LoadProcesses': int(exp_config['load_processes']),
+        'PrefetchDepth': int(exp_config['prefetch_depth']),
+        'PrefetchMaxBytes': int(exp_config['prefetch_max_bytes']),
+        'StreamImageFrames': bool(exp_config['stream_frames']),
     }
     source_data_path = os.path.join(exp_root_path, SourceFilePath)
 
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import numpy as np
+
+RAW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'RAW')
+if RAW_DIR not in sys.path:
+    sys.path.append(RAW_DIR)
+import RAWSettings
+import SASFileIO
+
+
+def loadProfile(filename, **settings):
+    raw_settings = RAWSettings.RawGuiSettings()
+    raw_settings.set('ImageFormat', 'Numpy 2D Array')
+    raw_settings.set('Xcenter', 60.3)
+    raw_settings.set('Ycenter', 55.2)
+
+    for key, value in settings.items():
+        raw_settings.set(key, value)
+
+    sasm, img = SASFileIO.loadFile(filename, raw_settings)
+
+    if isinstance(sasm, list):
+        sasm = sasm[0]
+
+    return sasm
+
+
+def test_zinger_removal_with_start_point(tmp_path):
+    ''' Zinger removal runs over the whole profile, so the bins below
+    StartPoint that it looks at must be integrated '''
+
+    rng = np.random.RandomState(0)
+    filename = str(tmp_path / 'image.npy')
+    np.save(filename, rng.poisson(100, size = (120, 130)).astype(np.int32))
+
+    full = loadProfile(filename, ZingerRemoval = True)
+    selected = loadProfile(filename, ZingerRemoval = True, StartPoint = 25)
+
+    assert np.count_nonzero(selected.i[25:]) == len(selected.i) - 25
+    assert np.allclose(selected.i[25:], full.i[25:])